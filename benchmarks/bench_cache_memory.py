@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Compare L1 memory per entry across cache key/value formats and layouts.
+
+Without a Redis URL this only reports key + value payload bytes. With one,
+it writes N synthetic entries per format into that Redis in the flat and/or
+buckets layout, reports the used_memory delta per entry and the batch probe
+latency, then deletes them. Point it at a scratch instance, not production:
+
+    python benchmarks/bench_cache_memory.py -n 100000 --layout both \\
+        --redis-url redis://localhost:6379/15
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import time
+
+from snapfs_gateway.cache_keys import bucket_for_key, build_cache_key
+from snapfs_gateway.cache_values import encode_value
+from snapfs_gateway.config import settings
+
+FORMATS = [
+    # (label, key format, value format)
+    ("plain key / json value", "plain", "json"),
+    ("plain key / binary value", "plain", "binary"),
+    ("hashed key / json value", "hashed", "json"),
+    ("hashed key / binary value", "hashed", "binary"),
+]
+
+
+def synthetic_entries(n: int, seed: int = 0):
+    """Yield (path, size, mtime, value) tuples resembling scanner output."""
+    rng = random.Random(seed)
+    for i in range(n):
+        depth = rng.randint(3, 8)
+        dirs = "/".join(f"dir{rng.randint(0, 999):03d}" for _ in range(depth))
+        path = f"/mnt/projects/show{rng.randint(0, 20)}/{dirs}/file_{i:08d}.exr"
+        digest = hashlib.sha256(path.encode()).hexdigest()
+        yield (
+            path,
+            rng.randint(0, 1 << 32),
+            rng.randint(1_500_000_000, 1_700_000_000),
+            {"algo": "sha256", "hash": digest},
+        )
+
+
+def build_pairs(entries, key_format: str, value_format: str):
+    return [
+        (
+            build_cache_key(path=path, size=size, mtime=mtime, key_format=key_format),
+            encode_value(value, value_format),
+        )
+        for path, size, mtime, value in entries
+    ]
+
+
+def measure_redis(url: str, pairs, layout: str, batch: int = 1000):
+    """
+    Write `pairs` in the given L1 layout, then read them back in probe-sized
+    batches. Returns (used_memory bytes per entry, microseconds per probe).
+    """
+    import redis
+
+    r = redis.Redis.from_url(url)
+    written = set()
+    try:
+        before = r.info("memory")["used_memory"]
+        for start in range(0, len(pairs), batch):
+            pipe = r.pipeline(transaction=False)
+            for key, val in pairs[start : start + batch]:
+                if layout == "buckets":
+                    bucket, field = bucket_for_key(key)
+                    pipe.hset(bucket, field, val)
+                    if settings.cache_bucket_expiry == "field":
+                        pipe.hexpire(bucket, 3600, field)
+                    else:
+                        pipe.expire(bucket, 3600)
+                    written.add(bucket)
+                else:
+                    pipe.set(key, val, ex=3600)
+                    written.add(key)
+            pipe.execute()
+        after = r.info("memory")["used_memory"]
+
+        t0 = time.perf_counter()
+        for start in range(0, len(pairs), batch):
+            keys = [key for key, _ in pairs[start : start + batch]]
+            if layout == "buckets":
+                groups = {}
+                for key in keys:
+                    bucket, field = bucket_for_key(key)
+                    groups.setdefault(bucket, []).append(field)
+                pipe = r.pipeline(transaction=False)
+                for bucket, fields in groups.items():
+                    pipe.hmget(bucket, fields)
+                pipe.execute()
+            else:
+                r.mget(keys)
+        elapsed = time.perf_counter() - t0
+
+        return (after - before) / len(pairs), 1e6 * elapsed / len(pairs)
+    finally:
+        written = list(written)
+        for start in range(0, len(written), 1000):
+            r.delete(*written[start : start + 1000])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", type=int, default=10000, help="entries per format")
+    parser.add_argument(
+        "--redis-url",
+        default=os.getenv("SNAPFS_BENCH_REDIS_URL"),
+        help="scratch Redis to measure real memory use (optional)",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=["flat", "buckets", "both"],
+        default="flat",
+        help="L1 layout(s) to measure when --redis-url is given",
+    )
+    parser.add_argument(
+        "--bucket-prefix",
+        type=int,
+        default=settings.cache_bucket_prefix,
+        help=(
+            "hex chars per bucket id; scale down with -n to keep realistic"
+            " bucket sizes"
+        ),
+    )
+    parser.add_argument(
+        "--bucket-expiry",
+        choices=["field", "bucket"],
+        default=settings.cache_bucket_expiry,
+        help="per-field HEXPIRE (Redis 7.4+) or one EXPIRE per bucket",
+    )
+    args = parser.parse_args()
+    settings.cache_bucket_prefix = args.bucket_prefix
+    settings.cache_bucket_expiry = args.bucket_expiry
+
+    layouts = ["flat", "buckets"] if args.layout == "both" else [args.layout]
+    if not args.redis_url:
+        layouts = [None]
+
+    entries = list(synthetic_entries(args.n))
+    baseline = None
+    print(f"{args.n} entries per format")
+    for layout in layouts:
+        for label, key_format, value_format in FORMATS:
+            pairs = build_pairs(entries, key_format, value_format)
+            payload = sum(len(k) + len(v) for k, v in pairs) / len(pairs)
+            line = f"{label:28s} key+value {payload:7.1f} B/entry"
+            if layout:
+                label = f"[{layout}] {label}"
+                per_entry, probe_us = measure_redis(args.redis_url, pairs, layout)
+                line = (
+                    f"{label:38s} used_memory {per_entry:7.1f} B/entry"
+                    f"   probe {probe_us:6.2f} us"
+                )
+                payload = per_entry
+            if baseline is None:
+                baseline = payload
+            else:
+                line += f"   ({100.0 * (1 - payload / baseline):.0f}% smaller)"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,16 +14,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
+from .. import metrics
+from ..bloom import l2_filter
 from ..bus import bus
-from ..cache_keys import build_cache_key
+from ..cache_keys import build_cache_key, legacy_cache_key
+from ..config import settings
+from ..path_utils import normalize_path
+from ..singleflight import SingleFlight
+from ..warm import warmer
 
 router = APIRouter(prefix="/cache", tags=["cache"])
 
+# Concurrent L2 misses for the same key share one MySQL lookup + L1 hydrate
+_l2_flight = SingleFlight("l2")
+
 
 class FileProbe(BaseModel):
     path: str
@@ -45,6 +54,23 @@ class CacheResult(BaseModel):
     # dev: Optional[int] = None
 
 
+class WarmRequest(BaseModel):
+    prefix: str
+    dev: Optional[int] = None
+
+
+class WarmStatus(BaseModel):
+    job: str
+    prefix: str
+    dev: Optional[int] = None
+    status: str  # "running", "done", "failed" or "cancelled"
+    rows: int
+    written: int
+    truncated: bool
+    error: Optional[str] = None
+    elapsed: float
+
+
 @router.post("/batch", response_model=List[CacheResult])
 async def cache_batch(probes: List[FileProbe]):
     """
@@ -52,18 +78,22 @@ async def cache_batch(probes: List[FileProbe]):
     """
     results: List[CacheResult] = []
 
-    # First pass: L1 (Redis)
-    misses = []
-    for i, p in enumerate(probes):
-        key = build_cache_key(
+    keys = [
+        build_cache_key(
             path=p.path,
             size=p.size,
             mtime=p.mtime,
             inode=p.inode,
             dev=p.dev,
         )
-        entry = await bus.cache_get(key)
+        for p in probes
+    ]
+
+    # First pass: L1 (Redis), one MGET per chunk of keys
+    entries = await bus.cache_get_many(keys)
 
+    misses = []
+    for i, (p, key, entry) in enumerate(zip(probes, keys, entries)):
         if entry and "hash" in entry and "algo" in entry:
             results.append(
                 CacheResult(
@@ -76,21 +106,29 @@ async def cache_batch(probes: List[FileProbe]):
             results.append(CacheResult(status="MISS"))
             misses.append((i, p, key))
 
-    # Second pass: L2 (MySQL)
+    # Key format rollout: retry misses under their legacy (plain) key
+    if misses and settings.cache_key_dual_read:
+        misses = await _probe_legacy_keys(misses, results)
+
+    # Skip L2 for probes it is known not to have
     if misses:
-        # lazy import to avoid circulars
-        from ..db import lookup_file_hash
+        misses = await _l2_candidates(misses)
 
-        for idx, probe, key in misses:
-            hit = lookup_file_hash(probe)
+    # Second pass: L2 (MySQL), batched over a pooled connection and
+    # coalesced with concurrent requests missing the same keys
+    if misses:
+        probes_by_key = {key: probe for _, probe, key in misses}
+
+        async def lookup(keys: List[str]):
+            return await _lookup_l2(keys, probes_by_key)
+
+        hits = await _l2_flight.do_many([key for _, _, key in misses], lookup)
+
+        for (idx, _, _), hit in zip(misses, hits):
             if not hit:
                 continue
 
             algo, hash_hex = hit
-
-            # Hydrate Redis L1
-            await bus.cache_set(key, {"algo": algo, "hash": hash_hex})
-
             # Flip MISS to HIT
             results[idx] = CacheResult(
                 status="HIT",
@@ -99,3 +137,113 @@ async def cache_batch(probes: List[FileProbe]):
             )
 
     return results
+
+
+@router.post("/warm", response_model=WarmStatus, status_code=202)
+async def cache_warm(body: WarmRequest):
+    """
+    Bulk-load the L2 rows at or under `prefix` (optionally only on `dev`)
+    into L1 in the background, so a scanner about to walk that tree gets
+    L1 hits. Returns the job; poll GET /cache/warm/{job} on the same
+    gateway for progress. Asking for a prefix that is already being
+    warmed returns that job.
+
+    Responds 429 when SNAPFS_CACHE_WARM_MAX_JOBS jobs are running.
+    """
+    prefix = normalize_path(body.prefix)
+    if not prefix:
+        raise HTTPException(status_code=422, detail="prefix must not be empty.")
+
+    job = warmer.start(prefix, body.dev)
+    if job is None:
+        raise HTTPException(status_code=429, detail="Too many cache warm jobs running.")
+    return WarmStatus(**job.info())
+
+
+@router.get("/warm/{job_id}", response_model=WarmStatus)
+async def cache_warm_status(job_id: str):
+    job = warmer.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired warm job.")
+    return WarmStatus(**job.info())
+
+
+async def _l2_candidates(misses):
+    """
+    Drop the L1 misses that L2 is known not to have: keys L2 recently
+    missed (negative cache) and probes the L2 Bloom filter rules out.
+    Returns the misses still worth a MySQL lookup.
+    """
+    known = bus.l2_known_missing(key for _, _, key in misses)
+    if known:
+        misses = [miss for miss in misses if miss[2] not in known]
+
+    maybe = await l2_filter.might_have_files(
+        [(p.path, p.size, p.mtime, p.inode, p.dev) for _, p, _ in misses]
+    )
+    ruled_out = [key for (_, _, key), ok in zip(misses, maybe) if not ok]
+    if ruled_out:
+        metrics.incr("l2.bloom.skipped", len(ruled_out))
+        bus.l2_mark_missing(ruled_out)
+        misses = [miss for miss, ok in zip(misses, maybe) if ok]
+    return misses
+
+
+async def _lookup_l2(
+    keys: List[str], probes_by_key: Dict[str, FileProbe]
+) -> List[Optional[Tuple[str, str]]]:
+    """
+    Look up `keys` in L2 (MySQL), hydrate Redis L1 with the hits and
+    remember the misses in the negative cache.
+    """
+    # lazy import to avoid circulars
+    from ..db import lookup_file_hashes
+
+    hits = await lookup_file_hashes([probes_by_key[key] for key in keys])
+
+    hydrate = [
+        (key, {"algo": hit[0], "hash": hit[1]}) for key, hit in zip(keys, hits) if hit
+    ]
+    if hydrate:
+        await bus.cache_set_many(hydrate)
+    bus.l2_mark_missing(key for key, hit in zip(keys, hits) if not hit)
+
+    return hits
+
+
+async def _probe_legacy_keys(misses, results: List[CacheResult]):
+    """
+    Look up L1 misses under the key format used before a rollout. Hits
+    flip the result to HIT and are rewritten under the current key and
+    value format. Returns the misses that are still unresolved.
+    """
+    legacy = []
+    for miss in misses:
+        _, p, _ = miss
+        old_key = legacy_cache_key(
+            path=p.path,
+            size=p.size,
+            mtime=p.mtime,
+            inode=p.inode,
+            dev=p.dev,
+        )
+        if old_key:
+            legacy.append((miss, old_key))
+    if not legacy:
+        return misses
+
+    entries = await bus.cache_get_many([old_key for _, old_key in legacy])
+
+    found = set()
+    migrate = []
+    for ((idx, _, key), _), entry in zip(legacy, entries):
+        if not (entry and "hash" in entry and "algo" in entry):
+            continue
+        results[idx] = CacheResult(status="HIT", algo=entry["algo"], hash=entry["hash"])
+        migrate.append((key, {"algo": entry["algo"], "hash": entry["hash"]}))
+        found.add(idx)
+
+    if migrate:
+        await bus.cache_set_many(migrate)
+
+    return [miss for miss in misses if miss[0] not in found]
@@ -18,14 +18,19 @@ __doc__ = """
 Contains the /ingest API endpoint for receiving events from scanners/clients.
 """
 
-from typing import Any, Dict, List, Optional
+import asyncio
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 from pydantic import BaseModel
 
+from .. import json_utils, metrics, ndjson
+from ..bloom import l2_filter, l2_idents
 from ..bus import bus
-from ..cache_keys import build_cache_key
+from ..cache_keys import build_cache_key, is_inode_key, path_digest
 from ..config import settings
+from ..partitions import all_partitions_subject, partition_events, partition_subject
 from ..path_utils import normalize_path
 
 router = APIRouter(tags=["ingest"])
@@ -40,19 +45,56 @@ class IngestRequest(BaseModel):
     events: List[Event]
 
 
+class PublishChunk(BaseModel):
+    index: int
+    events: int
+    bytes: int
+    seq: Optional[int] = None
+    duplicate: bool = False
+    error: Optional[str] = None
+    partition: Optional[int] = None
+    # /ingest/stream micro-batch the chunk belongs to
+    batch: Optional[int] = None
+
+
 class IngestResponse(BaseModel):
     status: str
     received: int
     subject: Optional[str] = None
+    suppressed: int = 0
+    chunks: List[PublishChunk] = []
+
+
+class IngestStreamResponse(BaseModel):
+    status: str
+    received: int
+    subject: Optional[str] = None
+    suppressed: int = 0
+    batches: int = 0
+    # Messages published, and the chunks that failed to publish
+    published: int = 0
+    errors: List[PublishChunk] = []
 
 
 @router.post("/ingest", response_model=IngestResponse)
 async def ingest_events(
     body: IngestRequest,
+    response: Response,
     subject: Optional[str] = Query(
         None,
         description="Optional subject for routing; defaults to SNAPFS_SUBJECT.",
     ),
+    batch_id: Optional[str] = Query(
+        None,
+        description="Scanner batch id; makes retries of the same batch idempotent.",
+    ),
+    changed_only: Optional[bool] = Query(
+        None,
+        description=(
+            "Skip publishing unchanged upserts; defaults to"
+            " SNAPFS_INGEST_CHANGED_ONLY."
+        ),
+    ),
 ):
     """
     Ingest a list of events from scanners/clients.
@@ -60,26 +102,314 @@ async def ingest_events(
     For now we:
     - Normalize file paths into canonical SnapFS form
     - Seed Redis L1 cache for file.upsert events that include algo + hash
-    - Publish the entire event list to JetStream for downstream agents
+    - Publish the event list to JetStream for downstream agents, split
+      into size-bounded messages (and into partition subjects when
+      SNAPFS_PARTITIONS is set)
+
+    If any message fails to publish the response is a 502 listing each
+    chunk's outcome; retrying with the same `batch_id` is safe.
+
+    With `changed_only`, file.upsert events whose L1 entry already holds
+    the same algo and hash are not published (see _ingest).
+    """
+    subj = subject or settings.default_subject
+    events = [e.dict() for e in body.events]
+
+    return await _ingest(response, subj, events, batch_id, changed_only)
+
+
+@router.post("/ingest/raw", response_model=IngestResponse)
+async def ingest_events_raw(
+    request: Request,
+    response: Response,
+    subject: Optional[str] = Query(
+        None,
+        description="Optional subject for routing; defaults to SNAPFS_SUBJECT.",
+    ),
+    batch_id: Optional[str] = Query(
+        None,
+        description="Scanner batch id; makes retries of the same batch idempotent.",
+    ),
+    changed_only: Optional[bool] = Query(
+        None,
+        description=(
+            "Skip publishing unchanged upserts; defaults to"
+            " SNAPFS_INGEST_CHANGED_ONLY."
+        ),
+    ),
+):
+    """
+    Fast path for /ingest: same body, response and behavior, but the body is
+    parsed once (with orjson when installed) instead of being built into
+    Pydantic models, and only the fields the gateway uses are validated.
+
+    When path normalization changes nothing, the original request bytes are
+    forwarded to JetStream without re-serializing them.
     """
     subj = subject or settings.default_subject
-    received = len(body.events)
+    raw = await request.body()
+
+    try:
+        body = json_utils.loads(raw)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid JSON body: {e}")
+    events = _validate_raw_events(body)
+
+    # The original bytes can be forwarded only if they are just the envelope
+    return await _ingest(
+        response,
+        subj,
+        events,
+        batch_id,
+        changed_only,
+        raw=raw if len(body) == 1 else None,
+    )
+
+
+@router.post("/ingest/stream", response_model=IngestStreamResponse)
+async def ingest_events_stream(
+    request: Request,
+    response: Response,
+    subject: Optional[str] = Query(
+        None,
+        description="Optional subject for routing; defaults to SNAPFS_SUBJECT.",
+    ),
+    batch_id: Optional[str] = Query(
+        None,
+        description="Scanner batch id; makes retries of the same upload idempotent.",
+    ),
+    changed_only: Optional[bool] = Query(
+        None,
+        description=(
+            "Skip publishing unchanged upserts; defaults to"
+            " SNAPFS_INGEST_CHANGED_ONLY."
+        ),
+    ),
+):
+    """
+    Streaming /ingest: the body is NDJSON with one event object per line,
+    optionally compressed (Content-Encoding: gzip or zstd). Events are
+    validated as they arrive and ingested in micro-batches of
+    SNAPFS_INGEST_STREAM_BATCH events, each seeded and published like an
+    /ingest/raw request. Memory use is bounded by the micro-batch, not by
+    the size of the upload.
+
+    Micro-batch n is published with batch id `<batch_id>:b<n>`, so retrying
+    a whole upload with the same `batch_id` is safe. A malformed line ends
+    the request with a 422; the micro-batches before it were ingested.
+    The response sums up all micro-batches and is a 502 if any message
+    failed to publish.
+    """
+    subj = subject or settings.default_subject
+    encoding = request.headers.get("content-encoding", "identity").strip().lower()
+    error = ndjson.check_encoding(encoding)
+    if error:
+        raise HTTPException(status_code=415, detail=error)
+
+    summary = IngestStreamResponse(status="ok", received=0, subject=subj)
+    batch: List[Dict[str, Any]] = []
+
+    async def flush():
+        n = summary.batches
+        chunks, suppressed = await _ingest_batch(
+            subj, batch, f"{batch_id}:b{n}" if batch_id else None, changed_only
+        )
+        summary.received += len(batch)
+        summary.suppressed += suppressed
+        summary.batches += 1
+        for c in chunks:
+            if c["error"]:
+                summary.errors.append(PublishChunk(**c, batch=n))
+            else:
+                summary.published += 1
+        batch.clear()
+
+    lines = ndjson.iter_lines(
+        request.stream(), encoding, max_line=settings.ingest_stream_max_line
+    )
+    try:
+        async for lineno, line in lines:
+            try:
+                ev = json_utils.loads(line)
+            except ValueError as e:
+                raise HTTPException(
+                    status_code=422, detail=f"line {lineno}: invalid JSON ({e})"
+                )
+            _validate_raw_event(ev, f"line {lineno}")
+            batch.append(ev)
+            if len(batch) >= max(1, settings.ingest_stream_batch):
+                await flush()
+    except ndjson.LineTooLong as e:
+        raise HTTPException(status_code=413, detail=_stream_error(summary, str(e)))
+    except ndjson.CorruptBody as e:
+        raise HTTPException(status_code=400, detail=_stream_error(summary, str(e)))
+    except HTTPException as e:
+        raise HTTPException(
+            status_code=e.status_code, detail=_stream_error(summary, e.detail)
+        )
+    if batch:
+        await flush()
+
+    if summary.errors:
+        summary.status = "error"
+        response.status_code = 502
+    return summary
 
-    # 1) Seed Redis (L1 cache) for file.upsert events
-    for ev in body.events:
-        if ev.type != "file.upsert":
+
+def _stream_error(summary: IngestStreamResponse, error: str) -> str:
+    # Earlier micro-batches were already published; say how far we got
+    return f"{error}; {summary.received} events before it were ingested"
+
+
+async def _ingest(
+    response: Response,
+    subject: str,
+    events: List[Dict[str, Any]],
+    batch_id: Optional[str],
+    changed_only: Optional[bool] = None,
+    raw: Optional[bytes] = None,
+) -> IngestResponse:
+    """Ingest `events` (see _ingest_batch) and build the /ingest response."""
+    chunks, suppressed = await _ingest_batch(
+        subject, events, batch_id, changed_only, raw
+    )
+    return _ingest_response(response, len(events), subject, chunks, suppressed)
+
+
+async def _ingest_batch(
+    subject: str,
+    events: List[Dict[str, Any]],
+    batch_id: Optional[str],
+    changed_only: Optional[bool] = None,
+    raw: Optional[bytes] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Seed L1 and publish `events`; shared by the /ingest endpoints. Returns
+    the publish chunks and the number of suppressed events.
+
+    `raw` is the request's encoding of {"events": events}; it is published
+    as-is if path normalization and change-only filtering left the events
+    untouched.
+
+    In change-only mode, upserts whose (key, algo, hash) already match L1
+    are dropped from the publish, and L1 is seeded only after everything
+    else was published. A failed publish therefore leaves L1 alone, and
+    the scanner's retry publishes the same events again instead of having
+    them suppressed.
+    """
+    if changed_only is None:
+        changed_only = settings.ingest_changed_only
+
+    changed, seeds = _cache_seeds(events)
+
+    unchanged: Set[int] = set()
+    if changed_only and seeds:
+        unchanged = await _unchanged_events(seeds)
+        if unchanged:
+            metrics.incr("ingest.suppressed", len(unchanged))
+    else:
+        await _seed_l1(seeds)
+
+    publish = events
+    if unchanged:
+        publish = [ev for i, ev in enumerate(events) if i not in unchanged]
+    forward = raw if not (changed or unchanged) else None
+    chunks = (
+        await _publish(subject, publish, batch_id, payload=forward) if publish else []
+    )
+
+    if changed_only and seeds and not any(c["error"] for c in chunks):
+        await _seed_l1(seeds)
+
+    return chunks, len(unchanged)
+
+
+async def _publish(
+    subject: str,
+    events: List[Dict[str, Any]],
+    batch_id: Optional[str],
+    payload: Optional[bytes] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Publish events to `subject`, or with SNAPFS_PARTITIONS set, to each
+    event's partition subject (see partitions.py). Partitions are published
+    concurrently; each keeps the request's event order.
+    """
+    if settings.partitions <= 0:
+        return await bus.publish_events(
+            subject=subject, events=events, payload=payload, batch_id=batch_id
+        )
+
+    # One registry entry covers every partition subject
+    await bus.ensure_stream(settings.nats_stream, [all_partitions_subject(subject)])
+
+    groups = sorted(partition_events(events, settings.partitions).items())
+    results = await asyncio.gather(
+        *(
+            bus.publish_events(
+                subject=partition_subject(subject, n),
+                events=group,
+                batch_id=f"{batch_id}:p{n}" if batch_id else None,
+            )
+            for n, group in groups
+        )
+    )
+
+    chunks = []
+    for (n, _), part in zip(groups, results):
+        for chunk in part:
+            chunk["partition"] = n
+            chunks.append(chunk)
+    return chunks
+
+
+def _ingest_response(
+    response: Response,
+    received: int,
+    subject: str,
+    chunks: List[Dict[str, Any]],
+    suppressed: int = 0,
+) -> IngestResponse:
+    failed = any(c["error"] for c in chunks)
+    if failed:
+        response.status_code = 502
+    return IngestResponse(
+        status="error" if failed else "ok",
+        received=received,
+        subject=subject,
+        suppressed=suppressed,
+        chunks=[PublishChunk(**c) for c in chunks],
+    )
+
+
+# (event index, L1 key, L1 value, L2 Bloom filter idents)
+Seed = Tuple[int, str, Dict[str, Any], List[bytes]]
+
+
+def _cache_seeds(events: List[Dict[str, Any]]) -> Tuple[bool, List[Seed]]:
+    """
+    Normalize file paths in place and collect the L1 cache entries for
+    file.upsert events that carry algo + hash.
+
+    Returns (changed, seeds); changed is True if any event was modified by
+    path normalization.
+    """
+    changed = False
+    seeds: List[Seed] = []
+    for i, ev in enumerate(events):
+        if ev["type"] != "file.upsert":
             continue
 
-        data = ev.data or {}
+        data = ev["data"]
         algo = data.get("algo")
         hash_hex = data.get("hash")
 
         raw_path = data.get("path")
         path = normalize_path(raw_path) if raw_path is not None else None
-        if path is not None:
+        if path is not None and path != raw_path:
             # Make sure the normalized path is what gets published
             data["path"] = path
-            ev.data = data  # explicit, even though `data` is already the same dict
+            changed = True
 
         size = data.get("size")
         mtime = data.get("mtime")
@@ -93,26 +423,100 @@ async def ingest_events(
         ):
             continue
 
+        inode, dev = data.get("inode"), data.get("dev")
         key = build_cache_key(
-            path=path,
-            size=int(size),
-            mtime=float(mtime),
-            inode=data.get("inode"),
-            dev=data.get("dev"),
+            path=path, size=int(size), mtime=float(mtime), inode=inode, dev=dev
         )
-        await bus.cache_set(
-            key,
-            {
-                "algo": algo,
-                "hash": hash_hex,
-            },
-            ttl=settings.default_ttl,
+        value = {"algo": algo, "hash": hash_hex}
+        if is_inode_key(dev=dev, inode=inode):
+            # The key survives renames; remember the path so change-only
+            # ingest can tell a moved file from an unchanged one
+            value["path_digest"] = path_digest(path)
+        idents = l2_idents(path, int(size), float(mtime), inode, dev)
+        seeds.append((i, key, value, idents))
+
+    return changed, seeds
+
+
+async def _seed_l1(seeds: List[Seed]):
+    """
+    Seed Redis (L1 cache) in pipelined chunks. Repeated keys within a
+    request coalesce; the last event wins. The files are also added to the
+    L2 Bloom filter, since agents are about to write them to MySQL.
+    """
+    if seeds:
+        await bus.cache_set_many(
+            [(key, value) for _, key, value, _ in seeds], ttl=settings.default_ttl
         )
+        await l2_filter.add_many(i for _, _, _, idents in seeds for i in idents)
+
+
+async def _unchanged_events(seeds: List[Seed]) -> Set[int]:
+    """
+    Indexes of upserts whose L1 entry already has the same algo and hash
+    (and, for inode keys, the same path digest, so moves are published;
+    entries without one, e.g. hydrated from L2, never match).
+    Keys that occur more than once in the request are never suppressed,
+    since agents must see the events between the first and the last.
+    """
+    counts = Counter(key for _, key, _, _ in seeds)
+    seeds = [seed for seed in seeds if counts[seed[1]] == 1]
+    current = await bus.cache_get_many([key for _, key, _, _ in seeds])
+    return {
+        i
+        for (i, _, value, _), entry in zip(seeds, current)
+        if entry is not None
+        and entry.get("algo") == value["algo"]
+        and entry.get("hash") == value["hash"]
+        and entry.get("path_digest") == value.get("path_digest")
+    }
+
+
+# Fields the gateway reads from file event data, and the JSON types it accepts
+_FIELD_TYPES = {
+    "path": (str,),
+    "algo": (str,),
+    "hash": (str,),
+    "size": (int,),
+    "mtime": (int, float),
+    "inode": (int,),
+    "dev": (int,),
+}
 
-    # 2) Publish to JetStream as a single message with all events for agents
-    await bus.publish_events(
-        subject=subj,
-        events=[e.dict() for e in body.events],
-    )
 
-    return IngestResponse(status="ok", received=received, subject=subj)
+def _validate_raw_events(body: Any) -> List[Dict[str, Any]]:
+    """
+    Check the parts of a raw /ingest body the gateway touches: the
+    {"events": [...]} envelope, each event's type and data, and the
+    types of the file fields in _FIELD_TYPES. Everything else is passed
+    through untouched.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("events"), list):
+        raise HTTPException(status_code=422, detail='Body must be {"events": [...]}')
+
+    events = body["events"]
+    for i, ev in enumerate(events):
+        _validate_raw_event(ev, f"events[{i}]")
+    return events
+
+
+def _validate_raw_event(ev: Any, where: str):
+    """Validate one raw event; `where` names it in error messages."""
+    if not (
+        isinstance(ev, dict)
+        and isinstance(ev.get("type"), str)
+        and isinstance(ev.get("data"), dict)
+    ):
+        raise HTTPException(
+            status_code=422,
+            detail=f"{where} must be an object with a string type and object data",
+        )
+    data = ev["data"]
+    for field, types in _FIELD_TYPES.items():
+        val = data.get(field)
+        # bool is an int subclass, but never a valid size/inode/etc.
+        if val is not None and (isinstance(val, bool) or not isinstance(val, types)):
+            raise HTTPException(
+                status_code=422,
+                detail=f"{where}.data.{field} has an invalid type",
+            )
@@ -15,14 +15,26 @@
 # limitations under the License.
 
 import asyncio
-import json
+import time
 import uuid
-from typing import Dict, List
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 
+import nats.errors
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
+from nats.js.api import AckPolicy
 
+from .. import json_utils, metrics
 from ..bus import bus
 from ..config import settings
+from ..event_filter import EventFilter
+from ..framing import check_framing, encode_batch
+from ..partitions import (
+    all_partitions_subject,
+    is_partition_subject,
+    parse_partition,
+    partition_subject,
+)
 
 router = APIRouter(tags=["stream"])
 
@@ -35,24 +47,76 @@ async def stream_events(
     ),
     durable: str = Query(..., description="Durable consumer name, e.g. mysql or es"),
     batch: int = Query(100, description="Max messages per batch"),
+    window: int = Query(
+        1, description="Max batches sent but not yet acked (1 = stop-and-wait)"
+    ),
+    framing: str = Query(
+        "json", description="Batch encoding: json, raw or binary (see framing.py)"
+    ),
+    compress: str = Query(
+        "none", description="Binary frame compression: none, deflate or zstd"
+    ),
+    max_events: int = Query(
+        0, description="Max events per batch, splitting envelopes (0 = no limit)"
+    ),
+    max_bytes: int = Query(
+        0, description="Max payload bytes per batch, splitting envelopes (0 = no limit)"
+    ),
+    partition: Optional[str] = Query(
+        None,
+        description='Partition to consume: "<n>/<count>" or "auto" (see partitions.py)',
+    ),
+    types: Optional[str] = Query(
+        None, description="Only send these event types (comma separated)"
+    ),
+    prefix: List[str] = Query(
+        [], description="Only send events whose path is under this prefix (repeatable)"
+    ),
+    fields: Optional[str] = Query(
+        None, description="Only send these data fields of each event (comma separated)"
+    ),
 ):
     """
     WebSocket bridge between agents and NATS JetStream.
 
     Agents connect with something like:
-        ws://gateway/stream?subject=snapfs.files&durable=mysql&batch=100
+        ws://gateway/stream?subject=snapfs.files&durable=mysql&batch=100&window=4
 
     Server flow per connection:
       - Ensure JetStream stream exists for the subject
       - Create or attach to a durable pull consumer
-      - Loop:
-          - fetch up to `batch` messages
-          - send them to the client as a single JSON batch
-          - wait for an ACK message referencing the batch ID
-          - ACK all JetStream messages in that batch
+      - Loop (see StreamSession):
+          - while fewer than `window` batches are unacked, fetch up to
+            `batch` messages and send them as a single JSON batch
+          - concurrently, read ACK messages referencing batch IDs and
+            ACK all JetStream messages in each acked batch
+
+    With `max_events` and/or `max_bytes`, batches are sized by events
+    instead of messages and can be acked in part (see EventStreamSession).
+    `types`, `prefix` and `fields` filter and project events in the gateway
+    before they are encoded (see event_filter.py).
+
+    With `partition`, the connection claims one partition subject
+    (`<subject>.<n>`) and consumes it with the durable `<durable>-p<n>`.
+    A partition is consumed by one connection at a time, so several agent
+    instances can share a durable without reordering a file's events. The
+    claimed partition is announced first: {"type": "partition", ...}.
+    Without `partition` on a partitioned gateway, the connection consumes
+    every partition (`<subject>.*`) with the durable `<durable>-all`.
     """
     await websocket.accept()
 
+    framing_error = check_framing(framing, compress)
+    if not framing_error and partition is not None:
+        try:
+            wanted = parse_partition(partition, settings.partitions)
+        except ValueError as e:
+            framing_error = str(e)
+    if framing_error:
+        await websocket.send_json({"type": "error", "message": framing_error})
+        await websocket.close(code=1008)
+        return
+
     await bus.connect()
 
     try:
@@ -68,111 +132,756 @@ async def stream_events(
         await websocket.close(code=1011)
         return
 
-    stream_name = settings.nats_stream
-
-    # Ensure stream exists for this subject
-    await bus.ensure_stream(stream_name, [subject])
-
-    # Create / attach to durable pull consumer
-    try:
-        sub = await js.pull_subscribe(
-            subject=subject,
-            durable=durable,
-            stream=stream_name,
-        )
-    except Exception as e:
-        # Log the actual error server-side
-        print(
-            f"[gateway] Failed to create JetStream consumer for durable={durable!r}: {e!r}"
-        )
-        # Tell the client what went wrong
+    # Partition claims are held under the agent's own durable name
+    owner, lease = durable, None
+    if partition is not None:
+        lease = await bus.claim_partition(durable, settings.partitions, wanted)
+        if lease is None:
+            await websocket.send_json(
+                {
+                    "type": "error",
+                    "message": (
+                        f"No unclaimed partition for durable={durable}"
+                        f" ({partition})."
+                    ),
+                }
+            )
+            await websocket.close(code=1013)  # try again later
+            return
         await websocket.send_json(
             {
-                "type": "error",
-                "message": f"Failed to create JetStream consumer for durable={durable}: {e}",
+                "type": "partition",
+                "partition": lease[0],
+                "partitions": settings.partitions,
             }
         )
-        await websocket.close(code=1011)
-        return
-
-    pending_batches: Dict[str, List] = {}
+        subject = partition_subject(subject, lease[0])
+        durable = f"{durable}-p{lease[0]}"
+    elif settings.partitions > 0 and not is_partition_subject(
+        subject, settings.partitions
+    ):
+        # Partitioned ingest never publishes to the bare subject; read all
+        # partitions, under a durable of their own so an existing consumer
+        # bound to the bare subject is left alone
+        subject = all_partitions_subject(subject)
+        durable = f"{durable}-all"
 
     try:
-        print(f"[gateway] Client connected for subject={subject!r} durable={durable!r}")
-        while True:
-            # Fetch up to `batch` messages
-            try:
-                msgs = await sub.fetch(batch=batch, timeout=1.0)
-            except Exception:
-                msgs = []
-
-            if not msgs:
-                # No data available yet, small sleep to avoid tight loop
-                await asyncio.sleep(0.5)
-                continue
+        stream_name = settings.nats_stream
 
-            batch_id = str(uuid.uuid4())
-            items = []
+        # Ensure stream exists for this subject
+        await bus.ensure_stream(stream_name, [subject])
 
-            for idx, msg in enumerate(msgs):
-                try:
-                    payload = msg.data.decode("utf-8")
-                    data = json.loads(payload)
-                except Exception:
-                    # Fallback to raw string if JSON fails
-                    data = {"raw": msg.data.decode("utf-8", errors="replace")}
-
-                items.append(
-                    {
-                        "index": idx,
-                        "data": data,
-                    }
-                )
-
-            # Track msgs so we can ACK them when client acks the batch
-            pending_batches[batch_id] = msgs
-
-            # Send batch to client
+        # Create / attach to durable pull consumer
+        try:
+            sub = await js.pull_subscribe(
+                subject=subject,
+                durable=durable,
+                stream=stream_name,
+            )
+        except Exception as e:
+            # The stream may have changed under us; re-check it on the next connect
+            bus.forget_stream(stream_name)
+            # Log the actual error server-side
+            print(
+                f"[gateway] Failed to create JetStream consumer for durable={durable!r}: {e!r}"
+            )
+            # Tell the client what went wrong
             await websocket.send_json(
                 {
-                    "type": "events",
-                    "batch": batch_id,
-                    "messages": items,
+                    "type": "error",
+                    "message": f"Failed to create JetStream consumer for durable={durable}: {e}",
                 }
             )
+            await websocket.close(code=1011)
+            return
+
+        try:
+            ack_policy = (await sub.consumer_info()).config.ack_policy
+        except Exception:
+            ack_policy = None  # assume explicit acks
+
+        options = dict(
+            batch=batch,
+            window=window,
+            ack_policy=ack_policy,
+            framing=framing,
+            compress=compress,
+        )
+        event_filter = EventFilter.from_params(types, prefix, fields)
+        if max_events > 0 or max_bytes > 0 or event_filter is not None:
+            session = EventStreamSession(
+                websocket,
+                sub,
+                stream=stream_name,
+                durable=durable,
+                max_events=max_events,
+                max_bytes=max_bytes,
+                event_filter=event_filter,
+                **options,
+            )
+        else:
+            session = StreamSession(websocket, sub, **options)
+
+        try:
+            print(
+                f"[gateway] Client connected for subject={subject!r} durable={durable!r}"
+            )
+            await _run_session(session, owner, lease)
+
+        except WebSocketDisconnect as e:
+            # Client disconnected; unacked messages will be redelivered
+            print(f"[gateway] Client durable={durable!r} disconnected from stream: {e}")
+            return
+
+        except Exception as e:
+            print(f"[gateway] Error in stream for durable={durable!r}: {e!r}")
+            await websocket.close(code=1011)
+            return
+    finally:
+        if lease is not None:
+            await bus.release_partition(owner, lease)
+
+
+async def _run_session(session: "StreamSession", durable: str, lease=None):
+    """Run a session; with a partition lease, renew it and stop if it is lost."""
+    if lease is None:
+        await session.run()
+        return
+
+    run = asyncio.ensure_future(session.run())
+    keeper = asyncio.ensure_future(_keep_lease(durable, lease))
+    try:
+        await asyncio.wait({run, keeper}, return_when=asyncio.FIRST_COMPLETED)
+        if run.done():
+            return run.result()
+        # Another connection may own the partition now; stop to keep ordering
+        raise RuntimeError(f"lost the claim on partition {lease[0]}")
+    finally:
+        for task in (run, keeper):
+            task.cancel()
+        await asyncio.gather(run, keeper, return_exceptions=True)
+
+
+async def _keep_lease(durable: str, lease):
+    """
+    Renew `lease` every third of its TTL, retrying sooner after a failure.
+    Returns once it is lost: taken over, or not renewed by shortly before
+    it expires (e.g. this replica can't reach Redis while others can, and
+    may claim the partition once it expires).
+    """
+    ttl = settings.partition_lease_ttl
+    interval = ttl / 3
+    # Give up this long before expiry, so the session is closed before
+    # another connection can claim the partition
+    margin = ttl / 6
+    expires = time.monotonic() + ttl
+    delay = interval
+    while True:
+        await asyncio.sleep(delay)
+        started = time.monotonic()
+        budget = expires - margin - started
+        if budget <= 0:
+            return
+        try:
+            renewed = await asyncio.wait_for(
+                bus.renew_partition(durable, lease), budget
+            )
+        except Exception:
+            metrics.incr("stream.lease_errors")
+            if expires - margin - time.monotonic() <= 0:
+                return
+            delay = interval / 3
+        else:
+            if not renewed:
+                return
+            expires = started + ttl
+            delay = interval
+
+
+class StreamSession:
+    """
+    One agent connection on /stream.
+
+    The session keeps fetching and sending batches while fewer than
+    `window` batches are waiting for an ack. A separate reader task
+    handles agent messages, so acks can arrive at any time and in any
+    order:
+
+        {"type": "ack", "batch": "<id>"}     ACK the batch's JetStream messages
+        {"type": "nack", "batch": "<id>"}    NAK them for prompt redelivery
+        {"type": "window", "size": <n>}      change the window mid-stream
+
+    Fetching is event driven (see _fetch); an idle session long polls
+    JetStream and sends keepalive pings rather than sleeping in a loop.
+
+    A batch left unacked for SNAPFS_STREAM_ACK_TIMEOUT seconds stops
+    counting against the window; JetStream redelivers its messages once
+    the consumer's ack wait expires.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        sub,
+        batch: int,
+        window: int,
+        ack_policy=None,
+        framing: str = "json",
+        compress: str = "none",
+    ):
+        self.websocket = websocket
+        self.framing = framing
+        self.compress = compress
+        self.sub = sub
+        self.acker = BatchAcker(ack_policy)
+        self.batch = max(1, batch)
+        self.window = max(1, window)
+        # batch id -> (sent at, what the batch holds; JetStream msgs here)
+        self.pending: Dict[str, Tuple[float, Any]] = {}
+        self._space = asyncio.Event()
+        # adaptive fetch size, 1..batch; see _fetch
+        self.fetch_size = 1
+        self._fetch_backoff = 0.0
+        self._last_send = time.monotonic()
+
+    async def run(self):
+        reader = asyncio.create_task(self._read_agent_messages())
+        try:
+            while True:
+                await self._wait_for_window(reader)
 
-            # Wait for client ACK for this batch
+                batch = await self._next_batch(reader)
+                if batch is None:
+                    continue
+
+                await self._send_batch(*batch)
+                self._last_send = time.monotonic()
+        finally:
+            reader.cancel()
             try:
-                ack_msg = await websocket.receive_json()
-            except WebSocketDisconnect:
-                break
+                await reader
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def _next_batch(
+        self, reader: asyncio.Task
+    ) -> Optional[Tuple[List[bytes], Any]]:
+        """
+        Return (payloads, tracked) for the next batch, or None if there is
+        nothing to send yet. `tracked` is what the ack/nack hooks get back.
+        """
+        msgs = await self._fetch(reader)
+        if not msgs:
+            return None
+        return [m.data for m in msgs], msgs
+
+    async def _fetch(self, reader: asyncio.Task) -> List:
+        """
+        Fetch the next batch, returning as soon as messages are available.
+
+        Fetch size adapts to the backlog: a full fetch doubles the size (up
+        to `batch`) and is followed by a quick no-wait style fetch; a
+        partial fetch means we caught up, so the next fetch is a single
+        message long poll that wakes the moment something is published.
+        While idle, a {"type": "ping"} keepalive is sent every
+        SNAPFS_STREAM_KEEPALIVE seconds instead of polling.
+        """
+        if self.fetch_size > 1:
+            timeout, heartbeat = settings.stream_drain_timeout, None
+        else:
+            timeout = settings.stream_long_poll
+            heartbeat = min(5.0, timeout / 2)
+
+        fetch = asyncio.ensure_future(
+            self.sub.fetch(batch=self.fetch_size, timeout=timeout, heartbeat=heartbeat)
+        )
+        try:
+            await asyncio.wait({fetch, reader}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            fetch.cancel()
+            raise
+        if reader.done():
+            fetch.cancel()
+            reader.result()  # re-raise WebSocketDisconnect etc.
+
+        try:
+            msgs = fetch.result()
+        except (asyncio.TimeoutError, nats.errors.TimeoutError):
+            msgs = []
+        except Exception as e:
+            metrics.incr("stream.fetch_errors")
+            print(f"[gateway] Fetch failed on stream session: {e!r}")
+            self._fetch_backoff = min(5.0, self._fetch_backoff * 2 or 0.1)
+            await asyncio.sleep(self._fetch_backoff)
+            return []
+        self._fetch_backoff = 0.0
+
+        if len(msgs) >= self.fetch_size:
+            self.fetch_size = min(self.batch, self.fetch_size * 2)
+        else:
+            self.fetch_size = 1
+
+        if not msgs and time.monotonic() - self._last_send >= settings.stream_keepalive:
+            await self.websocket.send_json({"type": "ping"})
+            self._last_send = time.monotonic()
+        return msgs
+
+    async def _wait_for_window(self, reader: asyncio.Task):
+        while len(self.pending) >= self.window:
+            if reader.done():
+                reader.result()
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                self._expire_pending()
+
+    def _expire_pending(self):
+        cutoff = time.monotonic() - settings.stream_ack_timeout
+        for batch_id, (sent_at, tracked) in list(self.pending.items()):
+            if sent_at < cutoff:
+                del self.pending[batch_id]
+                self._on_expire(batch_id, tracked)
+
+    async def _send_batch(self, payloads: List[bytes], tracked: Any):
+        batch_id = str(uuid.uuid4())
+
+        # Track the batch so we can ACK its messages when the client acks it
+        self.pending[batch_id] = (time.monotonic(), tracked)
+        self._on_send(batch_id, tracked)
+
+        # Send batch to client
+        frame = encode_batch(self.framing, self.compress, batch_id, payloads)
+        if isinstance(frame, bytes):
+            await self.websocket.send_bytes(frame)
+        else:
+            await self.websocket.send_text(frame)
+
+    async def _read_agent_messages(self):
+        while True:
+            try:
+                msg = await self.websocket.receive_json()
+            except ValueError:
+                # Ignore malformed messages
+                continue
 
-            if not isinstance(ack_msg, dict):
-                # Ignore malformed messages, but don't ACK JetStream
-                pending_batches.pop(batch_id, None)
+            if not isinstance(msg, dict):
                 continue
 
-            ack_type = ack_msg.get("type")
-            ack_batch = ack_msg.get("batch")
-
-            if ack_type == "ack" and ack_batch == batch_id:
-                # ACK all JetStream msgs in this batch
-                for m in pending_batches.pop(batch_id, []):
-                    try:
-                        await m.ack()
-                    except Exception:
-                        # If ack fails, JetStream will redeliver later
-                        pass
+            msg_type = msg.get("type")
+            if msg_type == "window":
+                try:
+                    self.window = max(1, int(msg.get("size")))
+                except (TypeError, ValueError):
+                    continue
+                self._space.set()
+                continue
+
+            if msg_type not in ("ack", "nack"):
+                continue
+
+            batch_id = msg.get("batch")
+            entry = self.pending.get(batch_id)
+            if entry is None:
+                # Unknown or expired batch
+                continue
+
+            if msg_type == "ack":
+                done = self._on_ack(batch_id, entry[1], msg)
             else:
-                # Treat anything else as "do not ack"; messages will be redelivered
-                pending_batches.pop(batch_id, None)
+                self._on_nack(batch_id, entry[1])
+                done = True
+            if done:
+                del self.pending[batch_id]
+                self._space.set()
 
-    except WebSocketDisconnect as e:
-        # Client disconnected; unacked messages will be redelivered
-        print(f"[gateway] Client durable={durable!r} disconnected from stream: {e}")
-        return
+    # Hooks; `tracked` is the second item _next_batch returned
 
-    except Exception as e:
-        print(f"[gateway] Error in stream for durable={durable!r}: {e!r}")
-        await websocket.close(code=1011)
-        return
+    def _on_send(self, batch_id: str, tracked: Any):
+        self.acker.track(batch_id, tracked)
+
+    def _on_ack(self, batch_id: str, tracked: Any, msg: Dict[str, Any]) -> bool:
+        """Handle an agent ack; return True once the batch is fully acked."""
+        self.acker.ack(batch_id, tracked)
+        return True
+
+    def _on_nack(self, batch_id: str, tracked: Any):
+        self.acker.nak(batch_id, tracked)
+
+    def _on_expire(self, batch_id: str, tracked: Any):
+        # Not acked in time; JetStream will redeliver these messages
+        pass
+
+
+class EventStreamSession(StreamSession):
+    """
+    A /stream session whose batches are bounded by events and bytes rather
+    than by JetStream messages.
+
+    Each message published by /ingest is a whole {"events": [...]}
+    envelope of any size. Here envelopes are split or packed so a batch
+    holds at most `max_events` events and `max_bytes` bytes of payload
+    (one event larger than `max_bytes` still goes out, on its own). Batch
+    items stay {"events": [...]} envelopes, so agents read them as before;
+    an envelope that fits whole is forwarded as stored. A message that is
+    not an envelope counts as one event and is never split.
+
+    With an `event_filter`, only matching (projected) events are sent;
+    dropped events count as done, and messages with nothing left are acked
+    without being sent. Payloads that are not envelopes are dropped too.
+
+    Agents may ack the leading part of a batch, in batch order:
+
+        {"type": "ack", "batch": "<id>", "events": <n>}   first n events done
+
+    The batch keeps its window slot until it is fully acked or nacked. A
+    JetStream message is acked once all of its events are, whichever
+    batches carried them. The acked prefix of a partly acked message is
+    kept in Redis (SNAPFS_STREAM_PROGRESS_TTL), so if the message is
+    nacked or redelivered after a disconnect, those events are skipped.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        sub,
+        batch: int,
+        window: int,
+        *,
+        stream: str,
+        durable: str,
+        max_events: int = 0,
+        max_bytes: int = 0,
+        event_filter: Optional[EventFilter] = None,
+        **kwargs,
+    ):
+        super().__init__(websocket, sub, batch, window, **kwargs)
+        self.stream = stream
+        self.durable = durable
+        self.max_events = max(0, max_events)
+        self.max_bytes = max(0, max_bytes)
+        self.event_filter = event_filter
+        # messages with events left to send, in fetch order
+        self._carry: Deque[_MessageEvents] = deque()
+        self._tasks: set = set()
+
+    async def _next_batch(
+        self, reader: asyncio.Task
+    ) -> Optional[Tuple[List[bytes], Any]]:
+        if not self._carry:
+            for msg in await self._fetch(reader):
+                state = await self._load(msg)
+                if state is not None:
+                    self._carry.append(state)
+            if not self._carry:
+                return None
+
+        payloads: List[bytes] = []
+        parts: List[Tuple[_MessageEvents, int, int]] = []
+        events = size = 0
+        while self._carry and self._has_room(events, size):
+            state = self._carry[0]
+            start = state.next
+            data = state.data
+
+            whole = start == 0 and data is not None
+            if state.events is None or (
+                whole and self._fits(events, size, state.total, len(data))
+            ):
+                if payloads and not self._fits(events, size, state.total, len(data)):
+                    break  # an opaque payload is never split
+                stop, payload = state.total, data
+            else:
+                stop, payload = self._slice(state, events, size, first=not payloads)
+                if stop == start:
+                    break
+
+            state.next = stop
+            state.outstanding += 1
+            parts.append((state, start, stop))
+            payloads.append(payload)
+            events += stop - start
+            size += len(payload)
+            if stop >= state.total:
+                self._carry.popleft()
+
+        return payloads, _EventBatch(parts)
+
+    def _has_room(self, events: int, size: int) -> bool:
+        return (not self.max_events or events < self.max_events) and (
+            not self.max_bytes or size < self.max_bytes
+        )
+
+    def _fits(self, events: int, size: int, add_events: int, add_bytes: int) -> bool:
+        return (not self.max_events or events + add_events <= self.max_events) and (
+            not self.max_bytes or size + add_bytes <= self.max_bytes
+        )
+
+    def _slice(self, state: "_MessageEvents", events: int, size: int, first: bool):
+        """Take as many of `state`'s remaining events as fit the batch."""
+        head, tail = b'{"events":[', b"]}"
+        stop = state.next
+        encoded: List[bytes] = []
+        nbytes = len(head) + len(tail)
+        while stop < state.total:
+            part = json_utils.dumps(state.events[stop])
+            add = len(part) + (1 if encoded else 0)
+            if not self._fits(events, size, len(encoded) + 1, nbytes + add):
+                if first and not encoded:
+                    # An event larger than max_bytes goes out on its own
+                    encoded.append(part)
+                    stop += 1
+                break
+            encoded.append(part)
+            nbytes += add
+            stop += 1
+        return stop, head + b",".join(encoded) + tail
+
+    async def _load(self, msg) -> Optional["_MessageEvents"]:
+        try:
+            body = json_utils.loads(msg.data)
+        except ValueError:
+            body = None
+        events = body.get("events") if isinstance(body, dict) else None
+        if not isinstance(events, list):
+            events = None
+
+        data = msg.data
+        if self.event_filter is not None:
+            # Positions below (and saved progress) refer to the kept events
+            kept = self.event_filter.apply(events) if events is not None else []
+            if kept is not events:
+                events, data = kept, None
+
+        skip = 0
+        if events and msg.metadata.num_delivered > 1:
+            skip = await bus.stream_progress_get(
+                self.stream, self.durable, _stream_seq(msg)
+            )
+        state = _MessageEvents(msg, events, data, min(skip, len(events or ())))
+
+        self.acker.track(state.key, [msg])
+        if state.next >= state.total:
+            # empty envelope, or every event was acked on an earlier delivery
+            self._settle(state)
+            return None
+        return state
+
+    def _on_send(self, batch_id: str, tracked: Any):
+        pass  # messages are tracked one by one in _load
+
+    def _on_ack(self, batch_id: str, tracked: Any, msg: Dict[str, Any]) -> bool:
+        batch: _EventBatch = tracked
+        upto = msg.get("events")
+        try:
+            upto = batch.size if upto is None else min(batch.size, int(upto))
+        except (TypeError, ValueError):
+            return False
+
+        pos = 0
+        for state, start, stop in batch.parts:
+            lo = max(start, start + batch.acked - pos)
+            hi = min(stop, start + upto - pos)
+            pos += stop - start
+            if lo >= hi:
+                continue
+            state.acked.update(range(lo, hi))
+            if hi == stop:
+                state.outstanding -= 1
+            self._settle(state)
+        batch.acked = max(batch.acked, upto)
+        return batch.acked >= batch.size
+
+    def _on_nack(self, batch_id: str, tracked: Any):
+        batch: _EventBatch = tracked
+        pos = 0
+        for state, start, stop in batch.parts:
+            pos += stop - start
+            if pos <= batch.acked:
+                continue  # this part was fully acked already
+            state.failed = True
+            state.outstanding -= 1
+            self._settle(state)
+
+    def _on_expire(self, batch_id: str, tracked: Any):
+        self._on_nack(batch_id, tracked)
+
+    def _settle(self, state: "_MessageEvents"):
+        """Ack, nak or checkpoint a message after its events changed state."""
+        if state.settled:
+            return
+        seq = _stream_seq(state.msg)
+
+        if len(state.acked) >= state.total:
+            state.settled = True
+            self.acker.ack(state.key, [state.msg])
+            if state.saved:
+                self._spawn(bus.stream_progress_set(self.stream, self.durable, seq, 0))
+            return
+
+        done = state.acked_prefix()
+        if done > state.saved:
+            state.saved = done
+            self._spawn(bus.stream_progress_set(self.stream, self.durable, seq, done))
+
+        if state.failed and state.outstanding == 0 and state.next >= state.total:
+            # Every event was sent and some were not acked; redeliver the rest
+            state.settled = True
+            self.acker.nak(state.key, [state.msg])
+
+    def _spawn(self, coro: Awaitable[None]):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class _MessageEvents:
+    """Send and ack state of one JetStream message in an EventStreamSession."""
+
+    __slots__ = (
+        "msg",
+        "events",
+        "data",
+        "next",
+        "acked",
+        "outstanding",
+        "failed",
+        "settled",
+        "saved",
+    )
+
+    def __init__(
+        self, msg, events: Optional[List], data: Optional[bytes], skip: int = 0
+    ):
+        self.msg = msg
+        # None for a payload that is not an {"events": [...]} envelope
+        self.events = events
+        # payload to forward when sent whole; None if `events` was filtered
+        self.data = data
+        # index of the next event to send
+        self.next = skip
+        # indexes of acked events; a redelivery skips the acked prefix
+        self.acked = set(range(skip))
+        # sent batch parts not yet fully acked or nacked
+        self.outstanding = 0
+        self.failed = False
+        self.settled = False
+        # acked prefix last saved to Redis
+        self.saved = skip
+
+    @property
+    def key(self) -> str:
+        return f"m{id(self)}"
+
+    @property
+    def total(self) -> int:
+        return 1 if self.events is None else len(self.events)
+
+    def acked_prefix(self) -> int:
+        done = self.saved
+        while done in self.acked:
+            done += 1
+        return done
+
+
+class _EventBatch:
+    """Parts of messages sent in one EventStreamSession batch."""
+
+    __slots__ = ("parts", "size", "acked")
+
+    def __init__(self, parts: List[Tuple[_MessageEvents, int, int]]):
+        # (message state, first event index, end event index), in batch order
+        self.parts = parts
+        self.size = sum(stop - start for _, start, stop in parts)
+        # leading events of the batch acked so far
+        self.acked = 0
+
+
+class BatchAcker:
+    """
+    Acknowledges the JetStream messages of batches the agent acked.
+
+    With an AckAll consumer, one ack on the highest stream sequence covers
+    everything below it, so acks are only sent for the longest prefix of
+    batches (in send order) that is fully done. A nacked or expired batch
+    holds the prefix until its messages are acked again after redelivery,
+    so nothing is ever acked implicitly on the agent's behalf.
+
+    With AckExplicit, every message is acked as a fire-and-forget task,
+    at most SNAPFS_STREAM_MAX_ACKS_IN_FLIGHT at a time. AckNone consumers
+    need no acks at all. Ack failures are counted in
+    stream.ack_failures; JetStream redelivers those messages later.
+    """
+
+    def __init__(self, ack_policy=None):
+        self.ack_all = ack_policy == AckPolicy.ALL
+        self.ack_none = ack_policy == AckPolicy.NONE
+        self._sem = asyncio.Semaphore(max(1, settings.stream_max_acks_in_flight))
+        self._tasks = set()
+        # AckAll only: batch id -> (msgs, stream seqs, acked), in send order
+        self._order: "OrderedDict[str, Tuple[List, set, bool]]" = OrderedDict()
+        # AckAll only: stream seqs acked but not yet covered by an AckAll
+        self._done_seqs: set = set()
+
+    def track(self, batch_id: str, msgs: List):
+        if self.ack_all:
+            self._order[batch_id] = (msgs, {_stream_seq(m) for m in msgs}, False)
+
+    def ack(self, batch_id: str, msgs: List):
+        if self.ack_none:
+            return
+        if not self.ack_all:
+            for m in msgs:
+                self._spawn(m.ack)
+            return
+
+        entry = self._order.get(batch_id)
+        if entry is None:
+            return
+        self._order[batch_id] = (entry[0], entry[1], True)
+        self._done_seqs |= entry[1]
+
+        # Release the done prefix; ack the highest message the agent acked in it
+        highest = None
+        while self._order:
+            first = next(iter(self._order))
+            bmsgs, seqs, acked = self._order[first]
+            if not (acked or seqs <= self._done_seqs):
+                break
+            del self._order[first]
+            if acked:
+                for m in bmsgs:
+                    if highest is None or _stream_seq(m) > _stream_seq(highest):
+                        highest = m
+
+        if highest is not None:
+            floor = _stream_seq(highest)
+            self._spawn(highest.ack)
+            self._done_seqs = {seq for seq in self._done_seqs if seq > floor}
+            for _, seqs, _ in self._order.values():
+                seqs.difference_update([seq for seq in seqs if seq <= floor])
+
+    def nak(self, batch_id: str, msgs: List):
+        if self.ack_none:
+            return
+        # AckAll: the batch stays in the prefix until redelivered and acked
+        for m in msgs:
+            self._spawn(m.nak)
+
+    def _spawn(self, op: Callable[[], Awaitable[None]]):
+        task = asyncio.ensure_future(self._run(op))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, op: Callable[[], Awaitable[None]]):
+        async with self._sem:
+            try:
+                await op()
+            except Exception:
+                # If ack fails, JetStream will redeliver later
+                metrics.incr("stream.ack_failures")
+
+
+def _stream_seq(msg) -> int:
+    return msg.metadata.sequence.stream
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Bloom filter of the rows in L2 (MySQL file_cache), kept in a Redis bitmap
+shared by all gateway replicas.
+
+Each row is added under (path, size, mtime) and, when it has them, under
+(dev, inode, size, mtime), matching the L2 lookup strategies. The filter
+answers "definitely not in L2" or "maybe", so /cache/batch can skip MySQL
+for probes of files that were never hashed.
+
+One replica builds the filter from MySQL the first time (or whenever the
+bitmap parameters change); every replica adds rows from /ingest as it
+seeds L1. Until the build has finished the filter answers "maybe" for
+everything. Rows must reach MySQL through /ingest for the filter to stay
+complete; delete `<SNAPFS_L2_BLOOM_KEY>:ready` to rebuild it, e.g. after
+rows were loaded some other way or many were deleted.
+
+The bitmap does not grow. Each replica estimates its false positive rate
+from the share of bits set, after the build and then hourly, and logs a
+warning with a recommended SNAPFS_L2_BLOOM_BITS once it is too full.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from . import metrics
+from .bus import bus
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the shared "ready" flag while not ready
+_READY_RECHECK = 30.0
+# Seconds between fill checks of a ready filter, and the estimated false
+# positive rate above which it counts as undersized
+_SIZE_RECHECK = 3600.0
+_MAX_FP_RATE = 0.05
+# Redis strings, and so bitmaps, hold at most 512 MB
+_MAX_BITS = 1 << 32
+
+
+def bloom_offsets(item: bytes, bits: int, hashes: int) -> List[int]:
+    """Bit offsets for `item`, by double hashing one 128-bit digest."""
+    digest = hashlib.blake2b(item, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def l2_idents(
+    path: str,
+    size: int,
+    mtime: float,
+    inode: Optional[int] = None,
+    dev: Optional[int] = None,
+) -> List[bytes]:
+    """Filter members for one file: by path, and by inode when known."""
+    idents = [f"{path}\0{int(size)}\0{int(mtime)}".encode("utf-8")]
+    if inode is not None and dev is not None:
+        idents.append(f"inode\0{dev}\0{inode}\0{int(size)}\0{int(mtime)}".encode())
+    return idents
+
+
+def recommended_bits(
+    idents: float, fp_rate: float = 0.01, headroom: float = 2.0
+) -> int:
+    """Bitmap size for `idents` members (times `headroom`) at `fp_rate`."""
+    n = max(1.0, idents * headroom)
+    return min(_MAX_BITS, math.ceil(-n * math.log(fp_rate) / math.log(2) ** 2))
+
+
+class L2Filter:
+    def __init__(self):
+        self._ready = False
+        self._ready_checked_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        # Result of the last fill check (see _check_size)
+        self._size: Optional[Dict[str, Any]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.l2_bloom_enabled and bus.redis is not None
+
+    def start(self):
+        """Build the filter in the background unless it already exists."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._build_if_needed())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def might_contain_many(self, idents: List[bytes]) -> List[bool]:
+        """
+        False for idents definitely not in L2, True for maybe. Everything
+        is a maybe while the filter is disabled, unbuilt or unreachable.
+        """
+        if not idents or not self.enabled or not await self._is_ready():
+            return [True] * len(idents)
+
+        k = settings.l2_bloom_hashes
+        try:
+            pipe = bus.redis.pipeline(transaction=False)
+            for ident in idents:
+                for offset in bloom_offsets(ident, settings.l2_bloom_bits, k):
+                    pipe.getbit(settings.l2_bloom_key, offset)
+            bits = await pipe.execute()
+        except Exception as e:
+            logger.warning("L2 Bloom filter check failed (%s); querying MySQL.", e)
+            return [True] * len(idents)
+
+        return [all(bits[i * k : (i + 1) * k]) for i in range(len(idents))]
+
+    async def might_have_files(self, files: List[Tuple]) -> List[bool]:
+        """
+        might_contain_many for (path, size, mtime, inode, dev) tuples. With
+        SNAPFS_L2_LOOKUP_MODE=inode a file is a maybe if either its inode or
+        its path is, since a renamed file is found by inode.
+        """
+        by_inode = settings.l2_lookup_mode == "inode"
+        groups = [l2_idents(*f) if by_inode else l2_idents(*f[:3]) for f in files]
+        maybe = iter(
+            await self.might_contain_many([i for group in groups for i in group])
+        )
+        return [any([next(maybe) for _ in group]) for group in groups]
+
+    async def add_many(self, idents: Iterable[bytes]):
+        """Add rows to the filter (a no-op while it is disabled)."""
+        if not self.enabled:
+            return
+        pipe = bus.redis.pipeline(transaction=False)
+        for ident in idents:
+            for offset in bloom_offsets(
+                ident, settings.l2_bloom_bits, settings.l2_bloom_hashes
+            ):
+                pipe.setbit(settings.l2_bloom_key, offset, 1)
+        await pipe.execute()
+
+    async def _is_ready(self) -> bool:
+        if self._ready:
+            return True
+        now = time.monotonic()
+        if now - self._ready_checked_at < _READY_RECHECK:
+            return False
+        self._ready_checked_at = now
+        try:
+            self._ready = await bus.redis.get(_ready_key()) == _params()
+        except Exception:
+            self._ready = False
+        return self._ready
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        return self._size if self.enabled else None
+
+    async def _build_if_needed(self):
+        # Retry until the filter is ready: MySQL may be down, or another
+        # replica's build may die before it finishes
+        while not await self._try_build():
+            await asyncio.sleep(2 * _READY_RECHECK)
+        while True:
+            await self._check_size()
+            await asyncio.sleep(_SIZE_RECHECK)
+
+    async def _check_size(self):
+        """
+        Estimate the members and false positive rate from the share of bits
+        set, and warn if the filter is undersized for them.
+        """
+        bits, k = settings.l2_bloom_bits, settings.l2_bloom_hashes
+        try:
+            fill = await bus.redis.bitcount(settings.l2_bloom_key) / bits
+        except Exception as e:
+            logger.warning("Failed to check L2 Bloom filter fill (%s).", e)
+            return
+
+        idents = -bits / k * math.log(1 - fill) if fill < 1 else math.inf
+        fp_rate = fill**k
+        self._size = {
+            "bits": bits,
+            "fill": round(fill, 4),
+            "idents": None if math.isinf(idents) else int(idents),
+            "fp_rate": round(fp_rate, 4),
+        }
+        if fp_rate > _MAX_FP_RATE:
+            logger.warning(
+                "L2 Bloom filter is undersized: ~%.0f%% false positives at %.0f%%"
+                " fill; set SNAPFS_L2_BLOOM_BITS to at least %d (changing it"
+                " rebuilds the filter).",
+                100 * fp_rate,
+                100 * fill,
+                recommended_bits(idents if not math.isinf(idents) else bits),
+            )
+
+    async def _try_build(self) -> bool:
+        redis = bus.redis
+        try:
+            if await redis.get(_ready_key()) == _params():
+                self._ready = True
+                return True
+
+            # One replica builds; the others pick up the ready flag later
+            lock = f"{settings.l2_bloom_key}:build"
+            if not await redis.set(lock, b"1", nx=True, ex=3600):
+                return False
+        except Exception as e:
+            logger.warning("Failed to check L2 Bloom filter (%s).", e)
+            return False
+
+        try:
+            # lazy import to avoid circulars
+            from .db import iter_file_idents
+
+            started = time.monotonic()
+            rows = 0
+            async for chunk in iter_file_idents(settings.cache_chunk_size):
+                await self.add_many(i for row in chunk for i in l2_idents(*row))
+                rows += len(chunk)
+            await redis.set(_ready_key(), _params())
+            self._ready = True
+            metrics.incr("l2.bloom.rows_loaded", rows)
+            logger.info(
+                "Built L2 Bloom filter from %d rows in %.1fs.",
+                rows,
+                time.monotonic() - started,
+            )
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(
+                "Failed to build L2 Bloom filter (%s); L2 is always queried.", e
+            )
+            return False
+        finally:
+            try:
+                await redis.delete(lock)
+            except Exception:
+                pass  # expires on its own
+
+
+def _ready_key() -> str:
+    return f"{settings.l2_bloom_key}:ready"
+
+
+def _params() -> bytes:
+    # A bitmap built with other parameters or idents must be rebuilt before use
+    return f"2:{settings.l2_bloom_bits}:{settings.l2_bloom_hashes}".encode()
+
+
+l2_filter = L2Filter()
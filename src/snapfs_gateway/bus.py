@@ -14,41 +14,107 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import json
 import logging
-from typing import Any, Dict, List, Optional
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 import nats
 from nats.js.api import StreamConfig
-from nats.js.errors import APIError as JSAPIError
+from nats.js.errors import NotFoundError as JSNotFoundError
 from redis import asyncio as aioredis
 
+from . import json_utils, metrics
+from .cache_keys import bucket_for_key
+from .cache_values import decode_value, encode_value
 from .config import settings
+from .local_cache import LocalCache
+from .sharding import HashRing
 
 logger = logging.getLogger(__name__)
 
+# Seconds between flushes of queued L1 TTL refreshes (see _touch)
+_TOUCH_FLUSH_DELAY = 1.0
+
 
 class Bus:
     """
     Shared infra access:
-    - Redis (L1 cache)
+    - In-process L0 cache and L2 negative cache (optional) -- see local_cache.py
+    - Redis (L1 cache), with optional sliding expiry of hit entries; one
+      node, a Redis Cluster, or client-side shards (see sharding.py)
     - MySQL (L2 cache) -- see db.py
     - NATS + JetStream (event log)
     """
 
     def __init__(self):
         self._redis = None
+        # Separate pub/sub client (Redis Cluster); else pub/sub uses _redis
+        self._pubsub = None
+        # Client-side L1 shards; None keeps L1 on _redis
+        self._l1_nodes: List[Any] = []
+        self._ring: Optional[HashRing] = None
         self._nats = None
         self._js = None
+        self._instance_id = uuid.uuid4().hex
+        self._l0: Optional[LocalCache] = None
+        self._l0_task: Optional[asyncio.Task] = None
+        self._l2_negative: Optional[LocalCache] = None
+        # Keys whose L1 TTL was refreshed (or written) within the touch
+        # interval, and the refreshes queued for the next flush
+        self._touched: Optional[LocalCache] = None
+        self._touch_pending: Set[str] = set()
+        self._touch_task: Optional[asyncio.Task] = None
+        # stream name -> (checked at, subjects); see ensure_stream
+        self._streams: Dict[str, Tuple[float, List[str]]] = {}
+        self._streams_lock: Optional[asyncio.Lock] = None
 
     async def connect(self):
         # Redis
         if settings.redis_url and self._redis is None:
-            self._redis = aioredis.from_url(
-                settings.redis_url,
-                encoding="utf-8",
-                decode_responses=True,
+            # Raw bytes: cache values may use the compact binary encoding
+            if settings.redis_cluster:
+                self._redis = aioredis.RedisCluster.from_url(settings.redis_url)
+                # Pub/sub goes through a plain connection to the seed node;
+                # cluster PUBLISH reaches subscribers on every node
+                self._pubsub = aioredis.from_url(settings.redis_url)
+            else:
+                self._redis = aioredis.from_url(settings.redis_url)
+
+            if settings.redis_shard_urls:
+                urls = [
+                    u.strip() for u in settings.redis_shard_urls.split(",") if u.strip()
+                ]
+                self._l1_nodes = [aioredis.from_url(url) for url in urls]
+                self._ring = HashRing(urls, settings.redis_shard_vnodes)
+                logger.info("L1 sharded over %d Redis nodes", len(urls))
+
+        # L0 (optional in-process cache in front of Redis) and the L2
+        # negative cache; both are invalidated by writes on any replica
+        if self._redis is not None and self._l0_task is None:
+            if settings.l0_enabled:
+                self._l0 = LocalCache("l0", settings.l0_max_entries, settings.l0_ttl)
+            if settings.l2_negative_ttl > 0:
+                self._l2_negative = LocalCache(
+                    "l2neg", settings.l2_negative_max_entries, settings.l2_negative_ttl
+                )
+            if self._l0 is not None or self._l2_negative is not None:
+                self._l0_task = asyncio.create_task(self._l0_invalidation_listener())
+
+        # Sliding L1 expiry: hits queue TTL refreshes, sent in the background
+        if (
+            self._redis is not None
+            and self._touch_task is None
+            and settings.cache_touch_interval > 0
+        ):
+            self._touched = LocalCache(
+                "l1touch",
+                settings.cache_touch_max_entries,
+                settings.cache_touch_interval,
             )
+            self._touch_task = asyncio.create_task(self._touch_flusher())
 
         # NATS + JetStream
         if self._nats is None:
@@ -62,6 +128,49 @@ class Bus:
                 self._nats = None
                 self._js = None
 
+    async def close(self):
+        if self._l0_task is not None:
+            self._l0_task.cancel()
+            try:
+                await self._l0_task
+            except asyncio.CancelledError:
+                pass
+            self._l0_task = None
+        self._l0 = None
+        self._l2_negative = None
+        self._streams.clear()
+
+        if self._touch_task is not None:
+            self._touch_task.cancel()
+            try:
+                await self._touch_task
+            except asyncio.CancelledError:
+                pass
+            self._touch_task = None
+            try:
+                await self._flush_touches()
+            except Exception as e:
+                logger.warning("Failed to flush L1 TTL refreshes on close (%s).", e)
+        self._touched = None
+
+        for node in self._l1_nodes:
+            await node.aclose()
+        self._l1_nodes = []
+        self._ring = None
+
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+        if self._nats is not None:
+            await self._nats.drain()
+            self._nats = None
+            self._js = None
+
     @property
     def redis(self):
         return self._redis
@@ -85,17 +194,348 @@ class Bus:
     async def cache_get(self, key: str) -> Optional[Dict[str, Any]]:
         if not self._redis:
             return None
-        val = await self._redis.get(key)
-        if not val:
-            return None
-        return json.loads(val)
+        return (await self.cache_get_many([key]))[0]
 
     async def cache_set(
         self, key: str, value: Dict[str, Any], ttl: Optional[int] = settings.default_ttl
     ):
         if not self._redis:
             return
-        await self._redis.set(key, json.dumps(value), ex=ttl)
+        await self.cache_set_many([(key, value)], ttl=ttl)
+
+    async def cache_get_many(
+        self, keys: List[str], chunk_size: Optional[int] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Batch version of cache_get. Returns one entry (or None) per key,
+        in the same order as `keys`. Keys not held in L0 are fetched from
+        L1 with one round trip per chunk (see _l1_read). With sliding
+        expiry, hits queue a TTL refresh (see _touch).
+        """
+        if not self._redis or not keys:
+            return [None] * len(keys)
+
+        raw: List[Any] = [None] * len(keys)
+        pending = list(range(len(keys)))
+        if self._l0 is not None:
+            pending = []
+            for i, key in enumerate(keys):
+                raw[i] = self._l0.get(key)
+                if raw[i] is None:
+                    pending.append(i)
+
+        chunk = max(1, chunk_size or settings.cache_chunk_size)
+        for start in range(0, len(pending), chunk):
+            idxs = pending[start : start + chunk]
+            vals = await self._l1_read([keys[i] for i in idxs])
+            for i, val in zip(idxs, vals):
+                if not val:
+                    continue
+                raw[i] = val
+                if self._l0 is not None:
+                    self._l0.set(keys[i], val)
+
+        if self._touched is not None:
+            self._touch(key for key, val in zip(keys, raw) if val)
+
+        return [decode_value(val) for val in raw]
+
+    async def cache_set_many(
+        self,
+        items: Iterable[Tuple[str, Dict[str, Any]]],
+        ttl: Optional[int] = settings.default_ttl,
+        chunk_size: Optional[int] = None,
+    ) -> int:
+        """
+        Batch version of cache_set. Writes (key, value) pairs with pipelined
+        commands, one round trip per chunk (see _l1_write).
+
+        Duplicate keys are coalesced first, the last value for a key wins.
+        With L0 or the L2 negative cache enabled, each chunk also publishes
+        its keys on the invalidation channel so other gateway replicas drop
+        stale copies. With client-side shards, each chunk's writes go to
+        all of its nodes concurrently.
+        Returns the number of distinct keys written.
+        """
+        if not self._redis:
+            return 0
+
+        fmt = settings.cache_value_format
+        entries = {key: encode_value(value, fmt) for key, value in items}
+        keys = list(entries)
+        chunk = max(1, chunk_size or settings.cache_chunk_size)
+        for start in range(0, len(keys), chunk):
+            part = keys[start : start + chunk]
+            pipes = []
+            for client, idxs in self._l1_groups(part):
+                pipe = client.pipeline(transaction=False)
+                self._l1_write(pipe, [(part[i], entries[part[i]]) for i in idxs], ttl)
+                pipes.append(pipe)
+
+            calls = []
+            if self._l0 is not None or self._l2_negative is not None:
+                note = json.dumps({"origin": self._instance_id, "keys": part})
+                if self._ring is None and self._pubsub is None:
+                    # L1 and pub/sub share a client: same round trip as the writes
+                    pipes[0].publish(settings.l0_channel, note)
+                else:
+                    calls.append(
+                        self._pubsub_redis().publish(settings.l0_channel, note)
+                    )
+            await asyncio.gather(*(pipe.execute() for pipe in pipes), *calls)
+
+            if self._l0 is not None:
+                for key in part:
+                    self._l0.set(key, entries[key])
+            if self._l2_negative is not None:
+                self._l2_negative.discard(part)
+            if self._touched is not None:
+                # Just written with a full TTL; no refresh needed for a while
+                for key in part:
+                    self._touched.set(key, True)
+        return len(keys)
+
+    def _l1_groups(self, keys: List[str]) -> List[Tuple[Any, List[int]]]:
+        """
+        Split `keys` by the L1 client that holds them, as (client, indexes
+        into keys) pairs. This is a single group unless L1 is sharded
+        client-side; a Redis Cluster client routes by hash slot itself.
+        """
+        if self._ring is None:
+            return [(self._redis, list(range(len(keys))))]
+        if settings.cache_layout == "buckets":
+            # All fields of a bucket must live on the same node
+            shard_keys = [bucket_for_key(key)[0] for key in keys]
+        else:
+            shard_keys = keys
+        return [
+            (self._l1_nodes[n], idxs)
+            for n, idxs in self._ring.group(shard_keys).items()
+        ]
+
+    def _pubsub_redis(self):
+        return self._pubsub if self._pubsub is not None else self._redis
+
+    async def _l1_read(self, keys: List[str]) -> List[Optional[bytes]]:
+        """
+        Fetch raw L1 values for `keys`, one round trip per L1 node, with
+        all nodes queried concurrently (see _l1_read_node).
+        """
+        groups = self._l1_groups(keys)
+        results = await asyncio.gather(
+            *(
+                self._l1_read_node(client, [keys[i] for i in idxs])
+                for client, idxs in groups
+            )
+        )
+
+        vals: List[Optional[bytes]] = [None] * len(keys)
+        for (_, idxs), got in zip(groups, results):
+            for i, val in zip(idxs, got):
+                vals[i] = val
+        return vals
+
+    async def _l1_read_node(self, client, keys: List[str]) -> List[Optional[bytes]]:
+        """
+        Fetch raw L1 values for `keys` from one client in one round trip.
+
+        flat layout:    one MGET (one per hash slot on Redis Cluster)
+        buckets layout: one pipelined HMGET per bucket
+        """
+        if settings.cache_layout != "buckets":
+            if isinstance(client, aioredis.RedisCluster):
+                return await client.mget_nonatomic(keys)
+            return await client.mget(keys)
+
+        groups: Dict[str, List[int]] = {}
+        fields = []
+        for i, key in enumerate(keys):
+            bucket, field = bucket_for_key(key)
+            groups.setdefault(bucket, []).append(i)
+            fields.append(field)
+
+        pipe = client.pipeline(transaction=False)
+        for bucket, idxs in groups.items():
+            pipe.hmget(bucket, [fields[i] for i in idxs])
+
+        vals: List[Optional[bytes]] = [None] * len(keys)
+        for idxs, got in zip(groups.values(), await pipe.execute()):
+            for i, val in zip(idxs, got):
+                vals[i] = val
+        return vals
+
+    def _l1_write(self, pipe, pairs: List[Tuple[str, bytes]], ttl: Optional[int]):
+        """
+        Queue L1 writes for (key, raw value) pairs on `pipe`.
+
+        flat layout:    SET key value EX ttl
+        buckets layout: HSET bucket field value, then either one EXPIRE per
+                        touched bucket ("bucket" expiry) or HEXPIRE per field
+                        ("field" expiry, needs Redis 7.4+)
+        """
+        if settings.cache_layout != "buckets":
+            for key, val in pairs:
+                pipe.set(key, val, ex=ttl)
+            return
+
+        per_field = settings.cache_bucket_expiry == "field"
+        touched = {}
+        for key, val in pairs:
+            bucket, field = bucket_for_key(key)
+            pipe.hset(bucket, field, val)
+            touched.setdefault(bucket, []).append(field)
+
+        if ttl:
+            for bucket, fields in touched.items():
+                if per_field:
+                    pipe.hexpire(bucket, ttl, *fields)
+                else:
+                    pipe.expire(bucket, ttl)
+
+    # ------------------------
+    # L1 sliding expiry
+    # ------------------------
+
+    def _touch(self, keys: Iterable[str]):
+        """
+        Queue a TTL refresh for L1 hits, at most once per key per
+        `settings.cache_touch_interval`. Refreshes are sent in batches by
+        _touch_flusher, never on the request path. If the queue is full,
+        further refreshes are dropped; those keys are retried on a later
+        hit once the interval has passed.
+        """
+        for key in keys:
+            if self._touched.get(key) is not None:
+                continue
+            if len(self._touch_pending) >= settings.cache_touch_max_entries:
+                metrics.incr("l1.touch.dropped")
+                continue
+            self._touched.set(key, True)
+            self._touch_pending.add(key)
+
+    async def _touch_flusher(self):
+        while True:
+            await asyncio.sleep(_TOUCH_FLUSH_DELAY)
+            try:
+                await self._flush_touches()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Failed to refresh L1 TTLs (%s).", e)
+
+    async def _flush_touches(self):
+        """
+        Send the queued TTL refreshes, one pipelined round trip per chunk
+        and L1 node.
+        """
+        if not self._touch_pending or self._redis is None:
+            return
+        keys = list(self._touch_pending)
+        self._touch_pending.clear()
+
+        chunk = max(1, settings.cache_chunk_size)
+        for start in range(0, len(keys), chunk):
+            part = keys[start : start + chunk]
+            pipes = []
+            for client, idxs in self._l1_groups(part):
+                pipe = client.pipeline(transaction=False)
+                self._l1_expire(pipe, [part[i] for i in idxs], settings.default_ttl)
+                pipes.append(pipe)
+            await asyncio.gather(*(pipe.execute() for pipe in pipes))
+        metrics.incr("l1.touch.refreshed", len(keys))
+
+    def _l1_expire(self, pipe, keys: List[str], ttl: int):
+        """
+        Queue TTL extensions for `keys` on `pipe`. GT only ever extends an
+        expiry, so entries written with a longer TTL (or none) keep it.
+
+        flat layout:    EXPIRE key ttl GT
+        buckets layout: EXPIRE bucket ttl GT once per bucket, or HEXPIRE
+                        bucket ttl GT fields ("field" expiry)
+        """
+        if settings.cache_layout != "buckets":
+            for key in keys:
+                pipe.expire(key, ttl, gt=True)
+            return
+
+        touched: Dict[str, List[str]] = {}
+        for key in keys:
+            bucket, field = bucket_for_key(key)
+            touched.setdefault(bucket, []).append(field)
+
+        per_field = settings.cache_bucket_expiry == "field"
+        for bucket, fields in touched.items():
+            if per_field:
+                pipe.hexpire(bucket, ttl, *fields, gt=True)
+            else:
+                pipe.expire(bucket, ttl, gt=True)
+
+    def l1_touch_stats(self) -> Optional[Dict[str, Any]]:
+        if self._touched is None:
+            return None
+        return {**self._touched.stats(), "pending": len(self._touch_pending)}
+
+    # ------------------------
+    # L0 (in-process) cache
+    # ------------------------
+
+    def l0_stats(self) -> Optional[Dict[str, Any]]:
+        return self._l0.stats() if self._l0 is not None else None
+
+    async def _l0_invalidation_listener(self):
+        """
+        Drop L0 (and L2 negative cache) entries written by other gateway
+        replicas. Messages on `settings.l0_channel` are
+        {"origin": <instance id>, "keys": [...]}.
+        """
+        caches = [c for c in (self._l0, self._l2_negative) if c is not None]
+        pubsub = self._pubsub_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(settings.l0_channel)
+            while True:
+                try:
+                    msg = await pubsub.get_message(timeout=1.0)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # We may have missed invalidations; start over cold.
+                    logger.warning(
+                        "L0 invalidation listener error (%s); clearing L0.", e
+                    )
+                    for cache in caches:
+                        cache.clear()
+                    await asyncio.sleep(1.0)
+                    continue
+
+                if msg is None:
+                    continue
+                try:
+                    note = json.loads(msg["data"])
+                except (TypeError, ValueError):
+                    continue
+                if note.get("origin") != self._instance_id:
+                    for cache in caches:
+                        cache.discard(note.get("keys") or ())
+        finally:
+            await pubsub.reset()
+
+    # ------------------------
+    # L2 negative cache
+    # ------------------------
+
+    def l2_known_missing(self, keys: Iterable[str]) -> Set[str]:
+        """Keys L2 recently had no row for (and nothing wrote since)."""
+        if self._l2_negative is None:
+            return set()
+        return {key for key in keys if self._l2_negative.get(key) is not None}
+
+    def l2_mark_missing(self, keys: Iterable[str]):
+        if self._l2_negative is not None:
+            for key in keys:
+                self._l2_negative.set(key, True)
+
+    def l2_negative_stats(self) -> Optional[Dict[str, Any]]:
+        return self._l2_negative.stats() if self._l2_negative is not None else None
 
     # ------------------------
     # JetStream helpers
@@ -105,43 +545,319 @@ class Bus:
         """
         Make sure a JetStream stream exists for the given subjects.
         If NATS/JetStream is unavailable, this becomes a no-op.
+
+        Known streams and their subjects are kept in a process-local
+        registry, so the server is only asked again when a subject is not
+        covered yet, after SNAPFS_STREAM_REFRESH seconds, or after
+        forget_stream() (called on publish/consume errors).
         """
         await self.connect()
         if self._js is None:
             return
 
+        known = self._streams.get(stream)
+        if known and self._stream_is_fresh(known, subjects):
+            return
+
+        if self._streams_lock is None:
+            self._streams_lock = asyncio.Lock()
+        async with self._streams_lock:
+            known = self._streams.get(stream)
+            if known and self._stream_is_fresh(known, subjects):
+                return
+            await self._sync_stream(stream, subjects)
+
+    def forget_stream(self, stream: str):
+        """Drop a stream from the registry so the next use re-checks the server."""
+        self._streams.pop(stream, None)
+
+    @staticmethod
+    def _stream_is_fresh(known: Tuple[float, List[str]], subjects: List[str]) -> bool:
+        checked_at, patterns = known
+        if time.monotonic() - checked_at > settings.nats_stream_refresh:
+            return False
+        return all(subject_matches(s, patterns) for s in subjects)
+
+    async def _sync_stream(self, stream: str, subjects: List[str]):
+        """
+        Create the stream, or add any of `subjects` its config does not
+        cover yet, then record it in the registry.
+        """
         try:
-            await self.js.stream_info(stream)
-        except JSAPIError:
+            info = await self.js.stream_info(stream)
+        except JSNotFoundError:
             cfg = StreamConfig(
                 name=stream,
                 subjects=subjects,
             )
-            await self.js.add_stream(cfg)
+            info = await self.js.add_stream(cfg)
+            logger.info("Created JetStream stream %s for %s", stream, subjects)
+        else:
+            current = list(info.config.subjects or [])
+            missing = [s for s in subjects if not subject_matches(s, current)]
+            if missing:
+                info.config.subjects = current + missing
+                info = await self.js.update_stream(info.config)
+                logger.info("Added subjects %s to JetStream stream %s", missing, stream)
+
+        self._streams[stream] = (
+            time.monotonic(),
+            list(info.config.subjects or subjects),
+        )
 
     async def publish_events(
         self,
         subject: str,
         events: List[Dict[str, Any]],
         stream: Optional[str] = None,
-    ):
+        payload: Optional[bytes] = None,
+        batch_id: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
         """
         Publish a list of events to JetStream under `subject`.
 
-        If NATS/JetStream is unavailable, this is a no-op (Redis L1 still works).
+        Events are split into {"events": [...]} messages that fit under the
+        server's max_payload (or SNAPFS_PUBLISH_MAX_BYTES). Chunks are sent
+        in order with async publish, keeping at most
+        SNAPFS_PUBLISH_MAX_ACKS_IN_FLIGHT acks outstanding.
+
+        When `batch_id` is given, each chunk carries the Nats-Msg-Id
+        "<batch_id>:<chunk index>" so a retried batch is deduplicated by the
+        stream. Without one, identical payloads are legitimate repeats (e.g.
+        a re-scan) and are always published.
+
+        `payload` is an already-encoded envelope for the same events; when
+        it fits in one message it is forwarded as-is.
+
+        Returns one outcome per chunk: {"index", "events", "bytes", "seq",
+        "duplicate", "error"}. If NATS/JetStream is unavailable, this is a
+        no-op (Redis L1 still works) and returns [].
         """
         await self.connect()
         if self._js is None:
             logger.warning(
                 "publish_events called but JetStream is not available; skipping publish."
             )
-            return
+            return []
 
         stream_name = stream or settings.nats_stream
         await self.ensure_stream(stream_name, [subject])
 
-        payload = json.dumps({"events": events}).encode("utf-8")
-        await self.js.publish(subject, payload)
+        # Leave headroom under max_payload for the subject and headers
+        max_payload = self._nats.max_payload
+        limit = settings.publish_max_bytes or max_payload - min(1024, max_payload // 8)
+        if payload is not None and len(payload) <= limit:
+            chunks = [(payload, len(events))]
+        else:
+            chunks = _split_events(events, limit)
+
+        results: List[Dict[str, Any]] = []
+        in_flight: List[Tuple[Dict[str, Any], Any]] = []
+        publish_async = getattr(self.js, "publish_async", None)
+
+        for index, (data, count) in enumerate(chunks):
+            result = {
+                "index": index,
+                "events": count,
+                "bytes": len(data),
+                "seq": None,
+                "duplicate": False,
+                "error": None,
+            }
+            results.append(result)
+            if len(data) > limit:
+                result["error"] = f"event larger than max payload ({limit} bytes)"
+                continue
+
+            headers = {"Nats-Msg-Id": f"{batch_id}:{index}"} if batch_id else None
+
+            try:
+                if publish_async is None:
+                    # Older nats-py: no async publish, wait for each ack.
+                    _record_ack(
+                        result, await self.js.publish(subject, data, headers=headers)
+                    )
+                    continue
+                future = await publish_async(subject, data, headers=headers)
+            except Exception as e:
+                result["error"] = str(e) or type(e).__name__
+                continue
+
+            in_flight.append((result, future))
+            if len(in_flight) >= settings.publish_max_acks_in_flight:
+                await _await_ack(*in_flight.pop(0))
+
+        for result, future in in_flight:
+            await _await_ack(result, future)
+
+        if any(r["error"] for r in results):
+            # e.g. the stream was deleted or lost a subject; re-check next time
+            self.forget_stream(stream_name)
+
+        return results
+
+    # ------------------------
+    # /stream event progress
+    # ------------------------
+
+    async def stream_progress_get(self, stream: str, durable: str, seq: int) -> int:
+        """
+        Number of leading events of message `seq` that `durable` already
+        acked on an earlier delivery (0 if none or unknown).
+        """
+        if not self._redis:
+            return 0
+        try:
+            raw = await self._redis.get(_progress_key(stream, durable, seq))
+            return int(raw) if raw else 0
+        except Exception:
+            metrics.incr("stream.progress_errors")
+            return 0
+
+    async def stream_progress_set(self, stream: str, durable: str, seq: int, done: int):
+        if not self._redis:
+            return
+        key = _progress_key(stream, durable, seq)
+        try:
+            if done:
+                await self._redis.set(key, done, ex=settings.stream_progress_ttl)
+            else:
+                await self._redis.delete(key)
+        except Exception:
+            metrics.incr("stream.progress_errors")
+
+    # ------------------------
+    # /stream partition leases
+    # ------------------------
+
+    async def claim_partition(
+        self, durable: str, partitions: int, partition: Optional[int] = None
+    ) -> Optional[Tuple[int, str]]:
+        """
+        Claim `partition` (or, if None, the first unclaimed one) of
+        `durable`'s partitions for this connection, so only one agent
+        instance consumes a partition at a time. Returns (partition, token)
+        or None if it is (they are all) taken.
+
+        The claim expires after SNAPFS_PARTITION_LEASE_TTL seconds unless
+        renewed. Without Redis, explicit partitions are granted unchecked
+        and automatic assignment is unavailable.
+        """
+        token = uuid.uuid4().hex
+        if not self._redis:
+            return (partition, token) if partition is not None else None
+
+        ttl_ms = int(settings.partition_lease_ttl * 1000)
+        candidates = [partition] if partition is not None else range(partitions)
+        for n in candidates:
+            if await self._redis.set(_lease_key(durable, n), token, nx=True, px=ttl_ms):
+                return n, token
+        return None
+
+    async def renew_partition(self, durable: str, lease: Tuple[int, str]) -> bool:
+        """Extend a claim; False if it expired or was taken over."""
+        if not self._redis:
+            return True
+        ttl_ms = int(settings.partition_lease_ttl * 1000)
+        renewed = await self._redis.eval(
+            _RENEW_LEASE, 1, _lease_key(durable, lease[0]), lease[1], ttl_ms
+        )
+        return bool(renewed)
+
+    async def release_partition(self, durable: str, lease: Tuple[int, str]):
+        if not self._redis:
+            return
+        try:
+            await self._redis.eval(
+                _RELEASE_LEASE, 1, _lease_key(durable, lease[0]), lease[1]
+            )
+        except Exception as e:
+            # It expires on its own
+            logger.warning(
+                "Failed to release partition %s of %s (%s).", lease[0], durable, e
+            )
+
+
+# Compare-and-set scripts for partition leases: only the holder may touch them
+_RENEW_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def _lease_key(durable: str, partition: int) -> str:
+    return f"snapfs:stream:lease:{settings.nats_stream}:{durable}:{partition}"
+
+
+def _progress_key(stream: str, durable: str, seq: int) -> str:
+    return f"snapfs:stream:progress:{stream}:{durable}:{seq}"
+
+
+def _split_events(events: List[Dict[str, Any]], limit: int) -> List[Tuple[bytes, int]]:
+    """
+    Encode `events` into as few {"events": [...]} envelopes of at most
+    `limit` bytes as possible, keeping event order. An event that cannot
+    fit on its own gets an oversized chunk of its own.
+    """
+    head, tail = b'{"events":[', b"]}"
+    chunks: List[Tuple[bytes, int]] = []
+    parts: List[bytes] = []
+    size = len(head) + len(tail)
+
+    for ev in events:
+        part = json_utils.dumps(ev)
+        if parts and size + len(part) + 1 > limit:
+            chunks.append((head + b",".join(parts) + tail, len(parts)))
+            parts, size = [], len(head) + len(tail)
+        size += len(part) + (1 if parts else 0)
+        parts.append(part)
+
+    if parts or not chunks:
+        chunks.append((head + b",".join(parts) + tail, len(parts)))
+    return chunks
+
+
+def _record_ack(result: Dict[str, Any], ack):
+    result["seq"] = ack.seq
+    result["duplicate"] = bool(ack.duplicate)
+
+
+async def _await_ack(result: Dict[str, Any], future):
+    try:
+        _record_ack(
+            result, await asyncio.wait_for(future, settings.publish_ack_timeout)
+        )
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+
+
+def subject_matches(subject: str, patterns: List[str]) -> bool:
+    """
+    True if NATS `subject` is covered by any of `patterns`, which may use
+    the `*` (one token) and `>` (one or more trailing tokens) wildcards.
+    """
+    tokens = subject.split(".")
+    for pattern in patterns:
+        ptokens = pattern.split(".")
+        for i, ptok in enumerate(ptokens):
+            if ptok == ">":
+                if len(tokens) > i:
+                    return True
+                break
+            if i >= len(tokens) or (ptok != "*" and ptok != tokens[i]):
+                break
+        else:
+            if len(ptokens) == len(tokens):
+                return True
+    return False
 
 
 bus = Bus()
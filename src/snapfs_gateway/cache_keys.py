@@ -14,7 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional
+import hashlib
+from typing import Optional, Tuple
+
+from .cache_values import PATH_DIGEST_SIZE
+from .config import settings
 
 
 def build_cache_key(
@@ -24,6 +28,7 @@ def build_cache_key(
     mtime: float,
     inode: Optional[int] = None,
     dev: Optional[int] = None,
+    key_format: Optional[str] = None,
 ) -> str:
     """
     Build a stable cache key for a file probe.
@@ -31,9 +36,63 @@ def build_cache_key(
     Prefer (dev, inode, size, mtime) when available to be robust
     against path moves. Fallback to path-based key if inode/dev
     are missing or zero.
+
+    Path-based keys embed the full path in the "plain" key format. The
+    "hashed" format (the default when SNAPFS_CACHE_KEY_FORMAT=hashed)
+    replaces path, size and mtime with a fixed-length digest.
     """
-    # TODO: consider hashing the path if worried about key length
     mti = int(mtime)
-    if dev and inode:
+    if is_inode_key(dev=dev, inode=inode):
         return f"snapfs:cache:inode:{dev}:{inode}:{size}:{mti}"
+    if (key_format or settings.cache_key_format) == "hashed":
+        digest = hashlib.blake2b(
+            f"{path}\0{size}\0{mti}".encode("utf-8", "surrogatepass"),
+            digest_size=16,
+        ).hexdigest()
+        return f"snapfs:cache:ph:{digest}"
     return f"snapfs:cache:path:{path}:{size}:{mti}"
+
+
+def is_inode_key(*, dev: Optional[int] = None, inode: Optional[int] = None) -> bool:
+    """True if build_cache_key keys a file by (dev, inode) rather than path."""
+    return bool(dev and inode)
+
+
+def path_digest(path: str) -> str:
+    """Short digest of a path, stored in inode-keyed entries (see cache_values)."""
+    return hashlib.blake2b(
+        path.encode("utf-8", "surrogatepass"), digest_size=PATH_DIGEST_SIZE
+    ).hexdigest()
+
+
+def legacy_cache_key(
+    *,
+    path: str,
+    size: int,
+    mtime: float,
+    inode: Optional[int] = None,
+    dev: Optional[int] = None,
+) -> Optional[str]:
+    """
+    Return the "plain" format key for a probe when it differs from the
+    key build_cache_key currently produces, else None.
+
+    Used to keep entries written before a key format change hitting
+    during rollout (SNAPFS_CACHE_KEY_DUAL_READ=1).
+    """
+    if settings.cache_key_format == "plain" or (dev and inode):
+        return None
+    return build_cache_key(path=path, size=size, mtime=mtime, key_format="plain")
+
+
+def bucket_for_key(key: str) -> Tuple[str, bytes]:
+    """
+    Map a cache key to its (bucket key, field) in the "buckets" L1 layout.
+
+    The key is hashed to 12 bytes; the first `settings.cache_bucket_prefix`
+    hex chars pick the HASH bucket and the raw digest is the field.
+    """
+    digest = hashlib.blake2b(
+        key.encode("utf-8", "surrogatepass"), digest_size=12
+    ).digest()
+    return f"snapfs:cache:b:{digest.hex()[: settings.cache_bucket_prefix]}", digest
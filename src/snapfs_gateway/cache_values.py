@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Encoding of L1 cache values.
+
+Two formats are understood on read, so entries written by older gateways
+keep hitting while a new format rolls out:
+
+- JSON (legacy): b'{"algo": "sha256", "hash": "<hex>"}'
+- Binary v1:     b"\\x01" + <algo id byte> + <raw digest bytes>
+- Binary v2:     b"\\x02" + <algo id byte> + <8 byte path digest> + <raw digest>
+
+Entries may carry a "path_digest" (see cache_keys.path_digest); /ingest
+stores one for inode-keyed entries, whose key does not include the path.
+Binary is only used when the algo has an id below and the hashes are
+lowercase hex, so decoding always gives back exactly what was stored.
+Anything else is written as JSON.
+"""
+
+import json
+from typing import Any, Dict, Optional, Union
+
+BINARY_V1 = 1
+BINARY_V2 = 2
+PATH_DIGEST_SIZE = 8
+
+# Append-only: the position of an algo is its on-the-wire id (+1).
+ALGOS = (
+    "md5",
+    "sha1",
+    "sha224",
+    "sha256",
+    "sha384",
+    "sha512",
+    "blake2b",
+    "blake2s",
+    "blake3",
+    "xxh32",
+    "xxh64",
+    "xxh3_64",
+    "xxh3_128",
+    "xxh128",
+    "crc32",
+)
+ALGO_IDS = {name: i + 1 for i, name in enumerate(ALGOS)}
+
+
+def encode_value(value: Dict[str, Any], fmt: str = "json") -> bytes:
+    """
+    Encode a {"algo", "hash"[, "path_digest"]} cache entry in the given
+    format ("json" or "binary").
+    """
+    if fmt == "binary" and set(value) <= {"algo", "hash", "path_digest"}:
+        algo_id = ALGO_IDS.get(value.get("algo"))
+        digest = _from_hex(value.get("hash"))
+        if algo_id is not None and digest:
+            if "path_digest" not in value:
+                return bytes((BINARY_V1, algo_id)) + digest
+            path_digest = _from_hex(value["path_digest"])
+            if path_digest and len(path_digest) == PATH_DIGEST_SIZE:
+                return bytes((BINARY_V2, algo_id)) + path_digest + digest
+    return json.dumps(value).encode("utf-8")
+
+
+def _from_hex(value: Any) -> Optional[bytes]:
+    """Bytes of a lowercase hex string, or None if it isn't one."""
+    if not isinstance(value, str):
+        return None
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return raw if raw.hex() == value else None
+
+
+def decode_value(raw: Union[bytes, str, None]) -> Optional[Dict[str, Any]]:
+    """
+    Decode a cache entry written in any supported format. Returns None for
+    empty or unrecognized payloads.
+    """
+    if not raw:
+        return None
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+
+    if raw[0] == BINARY_V1:
+        if len(raw) < 3 or raw[1] == 0 or raw[1] > len(ALGOS):
+            return None
+        return {"algo": ALGOS[raw[1] - 1], "hash": raw[2:].hex()}
+
+    if raw[0] == BINARY_V2:
+        head = 2 + PATH_DIGEST_SIZE
+        if len(raw) <= head or raw[1] == 0 or raw[1] > len(ALGOS):
+            return None
+        return {
+            "algo": ALGOS[raw[1] - 1],
+            "hash": raw[head:].hex(),
+            "path_digest": raw[2:head].hex(),
+        }
+
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
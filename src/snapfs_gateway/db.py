@@ -14,60 +14,291 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pymysql
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import aiomysql
 
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
+_pool: Optional[aiomysql.Pool] = None
+_pool_lock: Optional[asyncio.Lock] = None
 
-def get_mysql_connection():
+
+async def open_pool() -> Optional[aiomysql.Pool]:
     """
-    Return a *new* MySQL connection. Gateway does read-only lookups,
-    so per-request connections are fine. MySQL can pool internally.
+    Create the shared MySQL connection pool if it does not exist yet.
+
+    Called from app startup; also called lazily by `connection()` so the
+    gateway recovers if MySQL was unavailable when it started.
     """
-    return pymysql.connect(
-        host=settings.mysql_url_parsed.host,
-        user=settings.mysql_url_parsed.username,
-        password=settings.mysql_url_parsed.password,
-        database=settings.mysql_url_parsed.database,
-        port=settings.mysql_url_parsed.port or 3306,
-        charset="utf8mb4",
-        autocommit=True,
-    )
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            url = settings.mysql_url_parsed
+            _pool = await aiomysql.create_pool(
+                host=url.host,
+                user=url.username,
+                password=url.password or "",
+                db=url.database,
+                port=url.port or 3306,
+                charset="utf8mb4",
+                autocommit=True,
+                minsize=settings.mysql_pool_min_size,
+                maxsize=settings.mysql_pool_max_size,
+                pool_recycle=settings.mysql_pool_recycle,
+            )
+            logger.info(
+                "Opened MySQL pool to %s:%s (min=%d, max=%d)",
+                url.host,
+                url.port or 3306,
+                settings.mysql_pool_min_size,
+                settings.mysql_pool_max_size,
+            )
+    return _pool
+
+
+async def close_pool():
+    """
+    Close the shared MySQL pool, waiting for in-use connections to be released.
+    """
+    global _pool
+    if _pool is None:
+        return
+    pool, _pool = _pool, None
+    pool.close()
+    await pool.wait_closed()
+
+
+@asynccontextmanager
+async def connection():
+    """
+    Borrow a connection from the shared pool.
+
+    Raises asyncio.TimeoutError if no connection frees up within
+    `settings.mysql_pool_acquire_timeout` seconds.
+    """
+    pool = await open_pool()
+    acquire = asyncio.ensure_future(pool.acquire())
+    try:
+        conn = await asyncio.wait_for(
+            asyncio.shield(acquire), timeout=settings.mysql_pool_acquire_timeout
+        )
+    except BaseException:
+        # Timed out or cancelled: stop waiting for a connection, and hand
+        # back one the pool may have given us just before
+        acquire.cancel()
+        acquire.add_done_callback(lambda task: _release_acquired(pool, task))
+        raise
+    try:
+        if settings.mysql_pool_pre_ping:
+            # health check: transparently replaces connections the server dropped
+            await conn.ping(reconnect=True)
+        yield conn
+    finally:
+        pool.release(conn)
+
 
+def _release_acquired(pool, task: asyncio.Future):
+    if not task.cancelled() and task.exception() is None:
+        pool.release(task.result())
 
-def lookup_file_hash(probe):
+
+async def lookup_file_hash(probe):
     """
     Try to find a matching row in MySQL L2 cache.
     Returns (algo, hash) if found, else None.
     """
-    sql_base = """
-        SELECT algo, hash
+    return (await lookup_file_hashes([probe]))[0]
+
+
+# L2 lookup strategies per SNAPFS_L2_LOOKUP_MODE, tried in order: (columns
+# matched, whether probes it could not resolve fall back to the next
+# strategy). A strategy only sees probes that carry all of its columns; with
+# no fallback, only probes lacking those columns move on.
+LOOKUP_STRATEGIES: Dict[str, Tuple[Tuple[Tuple[str, ...], bool], ...]] = {
+    # path, plus inode/dev when the probe has them (misses moved files)
+    "path": (
+        (("path", "size", "mtime", "inode", "dev"), False),
+        (("path", "size", "mtime"), False),
+    ),
+    # inode first, so renamed/moved files still hit; path as a fallback
+    "inode": (
+        (("dev", "inode", "size", "mtime"), True),
+        (("path", "size", "mtime"), False),
+    ),
+}
+
+# Recommended file_cache indexes: one per lookup strategy. `path` is
+# indexed by prefix so long VARCHAR paths fit InnoDB's key size limit.
+RECOMMENDED_INDEXES = (
+    "CREATE INDEX idx_file_cache_path ON file_cache (path(255), size, mtime)",
+    "CREATE INDEX idx_file_cache_inode ON file_cache (dev, inode, size, mtime)",
+)
+
+
+async def lookup_file_hashes(
+    probes, mode: Optional[str] = None
+) -> List[Optional[Tuple[str, str]]]:
+    """
+    Batch version of lookup_file_hash. Returns one (algo, hash) or None per
+    probe, in the same order as `probes`.
+
+    All probes are resolved over a single pooled connection using multi-row
+    tuple IN queries of at most `settings.mysql_chunk_size` probes each,
+    one pass per strategy in LOOKUP_STRATEGIES[mode]:
+
+    - "path" (default): probes carrying inode/dev match on path and on
+      those columns, other probes on path only.
+    - "inode": probes carrying inode/dev first match on (dev, inode, size,
+      mtime), which survives renames and moves within a device; whatever
+      is still unresolved then matches on path.
+    """
+    strategies = LOOKUP_STRATEGIES[mode or settings.l2_lookup_mode]
+    results: List[Optional[Tuple[str, str]]] = [None] * len(probes)
+    if not probes:
+        return results
+
+    chunk = max(1, settings.mysql_chunk_size)
+    pending = list(range(len(probes)))
+    async with connection() as conn:
+        async with conn.cursor() as cur:
+            for columns, fallback in strategies:
+                wanted: Dict[tuple, List[int]] = {}
+                rest = []
+                for i in pending:
+                    ident = _probe_ident(probes[i], columns)
+                    if ident is None:
+                        rest.append(i)
+                    else:
+                        wanted.setdefault(ident, []).append(i)
+
+                idents = list(wanted)
+                for start in range(0, len(idents), chunk):
+                    part = idents[start : start + chunk]
+                    for row in await _select_file_hashes(cur, columns, part):
+                        algo, hash_hex = row[-2:]
+                        if not algo or not hash_hex:
+                            continue
+                        ident = _row_ident(columns, row[: len(columns)])
+                        for i in wanted.get(ident, ()):
+                            if results[i] is None:
+                                results[i] = (algo, hash_hex)
+
+                if fallback:
+                    pending = [i for i in pending if results[i] is None]
+                else:
+                    pending = rest
+
+    return results
+
+
+async def iter_file_idents(
+    chunk_size: Optional[int] = None,
+) -> AsyncIterator[List[tuple]]:
+    """
+    Stream the (path, size, mtime, inode, dev) of every file_cache row in
+    chunks.
+    """
+    sql = "SELECT path, size, mtime, inode, dev FROM file_cache"
+    async for rows in _stream_rows(sql, (), chunk_size):
+        yield [_row_ident(_IDENT_COLUMNS, row) for row in rows]
+
+
+async def iter_cached_files(
+    prefix: str,
+    dev: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Stream the file_cache rows at or under the normalized path `prefix`
+    (optionally only those on `dev`, and at most `limit` of them) in chunks
+    of dicts with path, size, mtime, inode, dev, algo and hash.
+
+    The prefix is matched as an index range ("<prefix>/" up to "<prefix>0",
+    '0' being the character after '/') rather than with LIKE, so the
+    path index is used and no escaping is needed.
+    """
+    base = prefix.rstrip("/")
+    sql = """
+        SELECT path, size, mtime, inode, dev, algo, hash
         FROM file_cache
-        WHERE path = %s
-          AND size = %s
-          AND mtime = %s
+        WHERE (path = %s OR (path >= %s AND path < %s))
     """
+    params: Tuple[Any, ...] = (base or "/", base + "/", base + "0")
+    if dev is not None:
+        sql += " AND dev = %s"
+        params += (dev,)
+    if limit:
+        # The server stops there; an iteration left early would otherwise
+        # drain every remaining row when its cursor closes
+        sql += " LIMIT %s"
+        params += (limit,)
 
-    params = [probe.path, probe.size, int(probe.mtime)]
+    columns = ("path", "size", "mtime", "inode", "dev", "algo", "hash")
+    async for rows in _stream_rows(sql, params, chunk_size):
+        yield [dict(zip(columns, row)) for row in rows]
 
-    # Optionally include inode/dev when present
-    # TODO: consider dropping path when inode/dev are present for file moves
-    if probe.inode is not None and probe.dev is not None:
-        sql = sql_base + " AND inode = %s AND dev = %s LIMIT 1;"
-        params.extend([probe.inode, probe.dev])
-    else:
-        sql = sql_base + " LIMIT 1;"
 
-    conn = get_mysql_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, tuple(params))
-            row = cur.fetchone()
-            if not row:
-                return None
-            algo, hash_hex = row
-            if not algo or not hash_hex:
-                return None
-            return algo, hash_hex
-    finally:
-        conn.close()
+async def _select_file_hashes(cur, columns: Sequence[str], idents: List[tuple]):
+    """
+    Run one multi-row lookup, matching `columns` against a tuple IN list.
+    Returns rows of (*columns, algo, hash).
+    """
+    cols = ", ".join(columns)
+    row_tmpl = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    sql = f"""
+        SELECT {cols}, algo, hash
+        FROM file_cache
+        WHERE ({cols}) IN ({", ".join([row_tmpl] * len(idents))});
+    """
+    await cur.execute(sql, tuple(v for ident in idents for v in ident))
+    return await cur.fetchall()
+
+
+async def _stream_rows(sql: str, params: Sequence[Any], chunk_size: Optional[int]):
+    """
+    Run `sql` with an unbuffered (server-side) cursor and yield its rows in
+    chunks, so memory stays bounded by the chunk size however many rows
+    match. Holds one pooled connection until the iteration finishes; a
+    caller that stops early should aclose() it.
+    """
+    chunk = max(1, chunk_size or settings.mysql_chunk_size)
+    async with connection() as conn:
+        async with conn.cursor(aiomysql.SSCursor) as cur:
+            await cur.execute(sql, tuple(params) or None)
+            while True:
+                rows = await cur.fetchmany(chunk)
+                if not rows:
+                    break
+                yield rows
+
+
+_IDENT_COLUMNS = ("path", "size", "mtime", "inode", "dev")
+_INT_COLUMNS = frozenset(("size", "mtime", "inode", "dev"))
+
+
+def _probe_ident(probe, columns: Sequence[str]) -> Optional[tuple]:
+    """A probe's values for `columns`, or None if it lacks any of them."""
+    values = [getattr(probe, col) for col in columns]
+    if any(v is None for v in values):
+        return None
+    return _row_ident(columns, values)
+
+
+def _row_ident(columns: Sequence[str], values: Sequence[Any]) -> tuple:
+    # mtime may come back as a float/Decimal depending on the column type
+    return tuple(
+        int(v) if v is not None and col in _INT_COLUMNS else v
+        for col, v in zip(columns, values)
+    )
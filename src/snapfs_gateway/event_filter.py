@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Server-side event filtering and projection for /stream.
+
+Events are kept if their type is one of `types` and their data.path (in
+SnapFS canonical form) is under one of `prefixes`; unset criteria match
+everything. A projection keeps only the listed data fields of each kept
+event (the event type is always kept).
+"""
+
+from typing import Any, Dict, Iterable, List, Optional
+
+from .path_utils import normalize_path
+
+
+class EventFilter:
+    def __init__(
+        self,
+        types: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        fields: Optional[Iterable[str]] = None,
+    ):
+        self.types = frozenset(types) if types else None
+        # "/a/b" matches "/a/b" itself and anything under "/a/b/"
+        self.prefixes = (
+            tuple(normalize_path(p).rstrip("/") for p in prefixes) if prefixes else None
+        )
+        self.fields = tuple(fields) if fields else None
+
+    @classmethod
+    def from_params(
+        cls,
+        types: Optional[str] = None,
+        prefixes: Optional[List[str]] = None,
+        fields: Optional[str] = None,
+    ) -> Optional["EventFilter"]:
+        """
+        Build a filter from /stream query parameters: comma separated
+        `types` and `fields`, and a list of path prefixes. Returns None if
+        nothing would be filtered.
+        """
+        type_list = _split(types)
+        field_list = _split(fields)
+        prefix_list = [p for p in prefixes or () if p]
+        if not (type_list or prefix_list or field_list):
+            return None
+        return cls(type_list, prefix_list, field_list)
+
+    def matches(self, event: Dict[str, Any]) -> bool:
+        if self.types is not None and event.get("type") not in self.types:
+            return False
+        if self.prefixes is not None:
+            data = event.get("data")
+            path = data.get("path") if isinstance(data, dict) else None
+            if not isinstance(path, str):
+                return False
+            path = normalize_path(path)
+            if not any(path == p or path.startswith(p + "/") for p in self.prefixes):
+                return False
+        return True
+
+    def project(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        if self.fields is None:
+            return event
+        data = event.get("data")
+        if not isinstance(data, dict):
+            return event
+        projected = dict(event)
+        projected["data"] = {f: data[f] for f in self.fields if f in data}
+        return projected
+
+    def apply(self, events: List[Any]) -> List[Any]:
+        """
+        Filter and project a list of events. Returns `events` itself when
+        nothing was dropped or changed, so callers can forward the original
+        payload.
+        """
+        kept = [
+            self.project(ev)
+            for ev in events
+            if isinstance(ev, dict) and self.matches(ev)
+        ]
+        if self.fields is None and len(kept) == len(events):
+            return events
+        return kept
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [part.strip() for part in (value or "").split(",") if part.strip()]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Encodings for /stream event batches.
+
+framing=json (default)
+    {"type": "events", "batch": "<id>", "messages": [{"index": i, "data": {...}}]}
+    Every JetStream payload is parsed and the whole batch re-encoded.
+
+framing=raw
+    The same JSON text frame, built by splicing the original JetStream
+    payloads into the envelope bytes without parsing them.
+
+framing=binary
+    One binary frame per batch, big-endian:
+
+        magic      4 bytes   b"SFB1"
+        compress   1 byte    0 = none, 1 = deflate (zlib), 2 = zstd
+        batch id  16 bytes   UUID bytes; ack with its canonical string form
+        count      4 bytes   number of messages
+        body                 count x (4 byte length + payload bytes),
+                             compressed as a whole per `compress`
+
+Text frames can still use the WebSocket permessage-deflate extension when
+the server and agent negotiate it.
+"""
+
+import json
+import struct
+import uuid
+import zlib
+from typing import List, Union
+
+try:
+    import zstandard
+except ImportError:  # optional dependency: pip install snapfs-gateway[zstd]
+    zstandard = None
+
+FRAMINGS = ("json", "raw", "binary")
+COMPRESSIONS = {"none": 0, "deflate": 1, "zstd": 2}
+
+BINARY_MAGIC = b"SFB1"
+
+
+def check_framing(framing: str, compress: str) -> str:
+    """Return an error message if the combination can't be served, else ""."""
+    if framing not in FRAMINGS:
+        return f"Unknown framing {framing!r}; expected one of {', '.join(FRAMINGS)}."
+    if compress not in COMPRESSIONS:
+        return (
+            f"Unknown compress {compress!r}; expected one of {', '.join(COMPRESSIONS)}."
+        )
+    if compress != "none" and framing != "binary":
+        return "compress is only supported with framing=binary."
+    if compress == "zstd" and zstandard is None:
+        return "zstd compression is not available on this gateway."
+    return ""
+
+
+def encode_batch(
+    framing: str, compress: str, batch_id: str, payloads: List[bytes]
+) -> Union[str, bytes]:
+    """
+    Encode one batch of JetStream payloads. Returns str for text frames
+    and bytes for binary frames.
+    """
+    if framing == "binary":
+        return _encode_binary(compress, batch_id, payloads)
+    if framing == "raw":
+        return _encode_raw(batch_id, payloads)
+    return _encode_json(batch_id, payloads)
+
+
+def _encode_json(batch_id: str, payloads: List[bytes]) -> str:
+    items = []
+    for idx, payload in enumerate(payloads):
+        try:
+            data = json.loads(payload.decode("utf-8"))
+        except Exception:
+            # Fallback to raw string if JSON fails
+            data = {"raw": payload.decode("utf-8", errors="replace")}
+        items.append({"index": idx, "data": data})
+    return json.dumps({"type": "events", "batch": batch_id, "messages": items})
+
+
+def _encode_raw(batch_id: str, payloads: List[bytes]) -> str:
+    parts = []
+    for idx, payload in enumerate(payloads):
+        # Gateway-published payloads are JSON objects; anything else is
+        # wrapped the same way the json framing does it.
+        if payload.lstrip()[:1] not in (b"{", b"["):
+            raw = payload.decode("utf-8", errors="replace")
+            payload = json.dumps({"raw": raw}).encode("utf-8")
+        parts.append(b'{"index":%d,"data":%s}' % (idx, payload))
+    head = b'{"type":"events","batch":"%s","messages":[' % batch_id.encode("ascii")
+    return (head + b",".join(parts) + b"]}").decode("utf-8", errors="replace")
+
+
+def _encode_binary(compress: str, batch_id: str, payloads: List[bytes]) -> bytes:
+    body = b"".join(struct.pack(">I", len(p)) + p for p in payloads)
+    if compress == "deflate":
+        body = zlib.compress(body)
+    elif compress == "zstd":
+        body = zstandard.ZstdCompressor().compress(body)
+    header = struct.pack(
+        ">4sB16sI",
+        BINARY_MAGIC,
+        COMPRESSIONS[compress],
+        uuid.UUID(batch_id).bytes,
+        len(payloads),
+    )
+    return header + body
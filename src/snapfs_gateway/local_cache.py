@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+In-process L0 cache that sits in front of Redis (L1).
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from . import metrics
+
+
+class LocalCache:
+    """
+    Size-bounded LRU map with a per-entry TTL.
+
+    Entries are stored as (expires_at, value) tuples; callers keep values
+    compact (e.g. the raw Redis payload rather than a decoded dict).
+    Hits, misses and evictions are counted under `<name>.*` in metrics.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            metrics.incr(f"{self.name}.misses")
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            metrics.incr(f"{self.name}.misses")
+            return None
+
+        self._data.move_to_end(key)
+        metrics.incr(f"{self.name}.hits")
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        evicted = 0
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            evicted += 1
+        if evicted:
+            metrics.incr(f"{self.name}.evictions", evicted)
+
+    def discard(self, keys: Iterable[str]):
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
@@ -14,12 +14,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+
 import uvicorn
 from fastapi import FastAPI
 
+from . import db, metrics
 from .api import cache, ingest, query, stream
+from .bloom import l2_filter
+from .warm import warmer
 from .bus import bus
 from .config import settings
+from .partitions import all_partitions_subject
+
+logger = logging.getLogger(__name__)
 
 
 def create_app() -> FastAPI:
@@ -31,11 +39,43 @@ def create_app() -> FastAPI:
     @app.on_event("startup")
     async def startup():
         await bus.connect()
+        subjects = [settings.default_subject]
+        if settings.partitions > 0:
+            subjects.append(all_partitions_subject(settings.default_subject))
+        try:
+            await bus.ensure_stream(settings.nats_stream, subjects)
+        except Exception as e:
+            logger.warning(
+                "Failed to check JetStream stream %s (%s).", settings.nats_stream, e
+            )
+        try:
+            await db.open_pool()
+        except Exception as e:
+            # MySQL not available; L2 lookups retry opening the pool on demand.
+            logger.warning("Failed to open MySQL pool (%s); L2 lookups degraded.", e)
+        l2_filter.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await warmer.stop()
+        await l2_filter.stop()
+        await db.close_pool()
+        await bus.close()
 
     @app.get("/healthz")
     async def healthz():
         return {"status": "ok", "env": settings.env}
 
+    @app.get("/stats")
+    async def stats():
+        return {
+            "counters": metrics.snapshot(),
+            "l0": bus.l0_stats(),
+            "l1_touch": bus.l1_touch_stats(),
+            "l2_negative": bus.l2_negative_stats(),
+            "l2_bloom": l2_filter.stats(),
+        }
+
     app.include_router(cache.router)
     app.include_router(ingest.router)
     app.include_router(query.router)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Simple in-process counters for gateway stats, exposed on /stats.
+"""
+
+from collections import Counter
+from typing import Dict
+
+counters: Counter = Counter()
+
+
+def incr(name: str, n: int = 1):
+    counters[name] += n
+
+
+def snapshot() -> Dict[str, int]:
+    return dict(counters)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Incremental NDJSON reading for streamed request bodies (/ingest/stream).
+
+The body arrives in chunks, optionally compressed as a whole per its
+Content-Encoding (gzip, or zstd when zstandard is installed).
+Decompressed output is produced in pieces of at most _PIECE_SIZE bytes and
+split into lines as it comes in, so a small, highly compressed chunk can't
+blow up memory: only one input chunk, one output piece and the current
+line are held at a time.
+"""
+
+import asyncio
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Optional, Tuple
+
+from .config import settings
+
+try:
+    import zstandard
+except ImportError:  # optional dependency: pip install snapfs-gateway[zstd]
+    zstandard = None
+
+ENCODINGS = ("identity", "gzip", "zstd")
+
+# Max decompressed bytes produced per step
+_PIECE_SIZE = 1 << 16
+
+_DECOMPRESS_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class CorruptBody(ValueError):
+    pass
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+def check_encoding(encoding: str) -> str:
+    """Return an error message if the body encoding can't be read, else ""."""
+    if encoding not in ENCODINGS:
+        expected = ", ".join(ENCODINGS)
+        return f"Unknown Content-Encoding {encoding!r}; expected one of {expected}."
+    if encoding == "zstd" and zstandard is None:
+        return "zstd request bodies are not supported on this gateway."
+    return ""
+
+
+async def iter_lines(
+    chunks: AsyncIterator[bytes], encoding: str = "identity", max_line: int = 1 << 20
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Yield (line number, line) for each non-blank line of the body, numbered
+    from 1. Raises LineTooLong once a line exceeds `max_line` bytes, and
+    CorruptBody if a compressed body can't be decompressed or is truncated.
+    """
+    if encoding == "gzip":
+        pieces = _gunzip(chunks)
+    elif encoding == "zstd":
+        pieces = _unzstd(chunks)
+    else:
+        pieces = chunks
+
+    pending = b""
+    lineno = 0
+    async for piece in pieces:
+        if not piece:
+            continue
+        lines = (pending + piece).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            lineno += 1
+            if len(line) > max_line:
+                raise LineTooLong(f"line {lineno} is longer than {max_line} bytes")
+            if line.strip():
+                yield lineno, line
+        if len(pending) > max_line:
+            raise LineTooLong(f"line {lineno + 1} is longer than {max_line} bytes")
+
+    if pending.strip():
+        yield lineno + 1, pending
+
+
+async def _gunzip(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # The body may hold several gzip members back to back (RFC 1952), e.g.
+    # from a compressor that flushes per chunk; each gets a new decompressor
+    decompressor = None
+    async for chunk in chunks:
+        while chunk:
+            if decompressor is None or decompressor.eof:
+                # 16 + MAX_WBITS: expect a gzip header and trailer
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                piece = decompressor.decompress(chunk, _PIECE_SIZE)
+            except zlib.error as e:
+                raise CorruptBody(f"corrupt gzip body ({e})") from e
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+            else:
+                chunk = decompressor.unconsumed_tail
+            yield piece
+    if decompressor is None or not decompressor.eof:
+        raise CorruptBody("truncated gzip body")
+
+
+class _ZstdFrames:
+    """
+    Follows frame and block boundaries in a zstd body as it is read, from
+    the headers alone, to tell whether the body ends cleanly between frames:
+    zstandard's stream reader ends silently on a truncated frame.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self._state = "magic"
+        self._need = 4  # header bytes to collect next
+        self._header = b""
+        self._skip = 0  # bytes of header fields or block content to pass over
+        self._checksum = False
+
+    @property
+    def complete(self) -> bool:
+        return (
+            bool(self.frames)
+            and self._state == "magic"
+            and not (self._header or self._skip)
+        )
+
+    def feed(self, data: bytes):
+        pos = 0
+        while pos < len(data) and self._state != "invalid":
+            if self._skip:
+                step = min(self._skip, len(data) - pos)
+                self._skip -= step
+                pos += step
+                continue
+            take = self._need - len(self._header)
+            self._header += data[pos : pos + take]
+            pos += take
+            if len(self._header) == self._need:
+                header, self._header = self._header, b""
+                self._parse(header)
+
+    def _parse(self, header: bytes):
+        value = int.from_bytes(header, "little")
+        if self._state == "magic":
+            if value == 0xFD2FB528:
+                self._state, self._need = "descriptor", 1
+            elif value & 0xFFFFFFF0 == 0x184D2A50:
+                self._state, self._need = "skippable", 4
+            else:
+                # not zstd; the reader reports it
+                self._state = "invalid"
+        elif self._state == "descriptor":
+            single_segment = value >> 5 & 1
+            self._checksum = bool(value >> 2 & 1)
+            # window descriptor, dictionary id, frame content size
+            self._skip = (
+                (0 if single_segment else 1)
+                + (0, 1, 2, 4)[value & 3]
+                + ((1 if single_segment else 0), 2, 4, 8)[value >> 6]
+            )
+            self._state, self._need = "block", 3
+        elif self._state == "block":
+            block_type = value >> 1 & 3
+            # an RLE block holds one byte, repeated on output
+            self._skip = 1 if block_type == 1 else value >> 3
+            if value & 1:
+                self._skip += 4 if self._checksum else 0
+                self.frames += 1
+                self._state, self._need = "magic", 4
+        else:
+            self._skip = value
+            self._state, self._need = "magic", 4
+
+
+class _AsyncSource:
+    """
+    Blocking file-like view of an async chunk iterator, for zstandard's
+    stream reader running in a worker thread. Each read pulls the next
+    chunk on the event loop only when the previous one is used up.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop):
+        self._chunks = chunks
+        self._loop = loop
+        self._buffer = b""
+        self.frames = _ZstdFrames()
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buffer:
+            future = asyncio.run_coroutine_threadsafe(
+                _next_chunk(self._chunks), self._loop
+            )
+            chunk = future.result()
+            if chunk is None:
+                return b""
+            self._buffer = chunk
+            self.frames.feed(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+async def _next_chunk(chunks: AsyncIterator[bytes]):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+_zstd_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_zstd_executor() -> ThreadPoolExecutor:
+    # Dedicated and bounded: each zstd upload keeps a thread waiting on the
+    # client for as long as it lasts, which mustn't starve the default
+    # executor (asyncio uses it for getaddrinfo, among others)
+    global _zstd_executor
+    if _zstd_executor is None:
+        _zstd_executor = ThreadPoolExecutor(
+            max_workers=max(1, settings.ingest_stream_zstd_threads),
+            thread_name_prefix="snapfs-zstd",
+        )
+    return _zstd_executor
+
+
+async def _unzstd(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # zstandard's decompressobj can't bound its output, so use a stream
+    # reader (in a thread, since it reads from a blocking source)
+    loop = asyncio.get_running_loop()
+    source = _AsyncSource(chunks, loop)
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        source, read_size=_PIECE_SIZE, read_across_frames=True
+    )
+    executor = _get_zstd_executor()
+    while True:
+        try:
+            piece = await loop.run_in_executor(executor, reader.read, _PIECE_SIZE)
+        except _DECOMPRESS_ERRORS as e:
+            raise CorruptBody(f"corrupt zstd body ({e})") from e
+        if not piece:
+            break
+        yield piece
+
+    if not source.frames.complete:
+        raise CorruptBody("truncated zstd body")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Partitioned subjects.
+
+With SNAPFS_PARTITIONS=N, /ingest publishes each event to one of N
+subjects, `<subject>.0` .. `<subject>.<N-1>`, picked by a stable hash of the
+file's normalized path (or of its (dev, inode), see SNAPFS_PARTITION_KEY).
+All events for a file land in the same partition, so agents consuming
+partitions in parallel still see each file's events in order. Paths are
+hashed in normalized form, since only file.upsert paths are rewritten at
+ingest.
+
+Nothing is published to the bare `<subject>` while partitioning is on;
+/stream connections without a partition consume `<subject>.*` instead.
+
+Events without a usable key (no path) go to partition 0.
+"""
+
+import hashlib
+from typing import Any, Dict, List, Optional
+
+from .config import settings
+from .path_utils import normalize_path
+
+
+def partition_for(
+    event: Dict[str, Any], partitions: int, key: Optional[str] = None
+) -> int:
+    """
+    Partition index for an event. `key` is "path" or "inode"; in inode mode
+    events without both dev and inode fall back to the path, so keep a
+    file's events consistent (always send inode, or never) for ordering.
+    """
+    if partitions <= 1:
+        return 0
+    data = event.get("data") or {}
+    ident = None
+    if (key or settings.partition_key) == "inode":
+        dev, inode = data.get("dev"), data.get("inode")
+        if dev is not None and inode is not None:
+            ident = f"inode\0{dev}\0{inode}"
+    if ident is None:
+        path = data.get("path")
+        if path is None:
+            return 0
+        ident = f"path\0{normalize_path(path)}"
+    digest = hashlib.blake2b(ident.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % partitions
+
+
+def partition_events(
+    events: List[Dict[str, Any]], partitions: int
+) -> Dict[int, List[Dict[str, Any]]]:
+    """Group events by partition, keeping their order within each partition."""
+    groups: Dict[int, List[Dict[str, Any]]] = {}
+    for ev in events:
+        groups.setdefault(partition_for(ev, partitions), []).append(ev)
+    return groups
+
+
+def partition_subject(subject: str, partition: int) -> str:
+    return f"{subject}.{partition}"
+
+
+def all_partitions_subject(subject: str) -> str:
+    """Subject filter covering every partition of `subject`."""
+    return f"{subject}.*"
+
+
+def is_partition_subject(subject: str, partitions: int) -> bool:
+    """True if `subject` already names one partition, e.g. snapfs.files.3."""
+    last = subject.rsplit(".", 1)[-1]
+    return "." in subject and last.isdigit() and int(last) < partitions
+
+
+def parse_partition(spec: str, partitions: int) -> Optional[int]:
+    """
+    Parse a /stream `partition` parameter: "auto" (returns None) or
+    "<n>/<count>", where count must match SNAPFS_PARTITIONS. Raises
+    ValueError with a client-facing message otherwise.
+    """
+    if partitions <= 0:
+        raise ValueError(
+            "Partitioning is not enabled on the gateway (SNAPFS_PARTITIONS)."
+        )
+    if spec == "auto":
+        return None
+    try:
+        n, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid partition {spec!r}; expected <n>/<count> or auto.")
+    if count != partitions:
+        raise ValueError(
+            f"Partition count {count} does not match the gateway's {partitions}."
+        )
+    if not 0 <= n < count:
+        raise ValueError(f"Partition {n} is out of range 0..{count - 1}.")
+    return n
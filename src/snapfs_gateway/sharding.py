@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Client-side sharding of L1 over several standalone Redis nodes.
+
+With SNAPFS_REDIS_SHARD_URLS set, every L1 entry lives on the node its key
+(or, in the buckets layout, its bucket) maps to on a consistent-hash ring.
+Each node is placed on the ring at SNAPFS_REDIS_SHARD_VNODES points derived
+from its URL, so adding or removing a node only moves about 1/N of the keys
+and the mapping does not depend on the order the URLs are listed in.
+"""
+
+import bisect
+import hashlib
+from typing import Dict, List, Sequence
+
+
+def _ring_hash(value: str) -> int:
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring over `nodes` (any stable names, e.g. URLs).
+    `node_for` returns the index of a key's node in `nodes`.
+    """
+
+    def __init__(self, nodes: Sequence[str], vnodes: int = 160):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        self.nodes = list(nodes)
+        points = sorted(
+            (_ring_hash(f"{node}#{v}"), n)
+            for n, node in enumerate(self.nodes)
+            for v in range(max(1, vnodes))
+        )
+        self._hashes = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def node_for(self, key: str) -> int:
+        i = bisect.bisect(self._hashes, _ring_hash(key))
+        return self._owners[i % len(self._owners)]
+
+    def group(self, keys: Sequence[str]) -> Dict[int, List[int]]:
+        """Indexes into `keys`, grouped by node index."""
+        groups: Dict[int, List[int]] = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.node_for(key), []).append(i)
+        return groups
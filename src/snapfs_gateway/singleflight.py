@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+In-process single-flight coalescing of concurrent lookups by key.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from . import metrics
+
+
+class SingleFlight:
+    """
+    Shares in-flight lookups between concurrent callers.
+
+    do_many() looks up only the keys no other caller is already looking up,
+    with one call to the lookup function; keys already in flight wait for
+    that other call's result instead. Keys looked up and keys coalesced
+    onto another call are counted under `<name>.lookups` and
+    `<name>.coalesced` in metrics.
+
+    Results are shared only while a lookup is in flight; nothing is cached.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # key -> (task running the lookup that covers it, index of its result)
+        self._inflight: Dict[str, Tuple[asyncio.Future, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do_many(
+        self, keys: List[str], lookup: Callable[[List[str]], Awaitable[List[Any]]]
+    ) -> List[Any]:
+        """
+        Resolve `keys`, returning one result per key in order. `lookup` is
+        called with the distinct keys this caller leads and must return one
+        result per key. If it fails, callers waiting on those keys get the
+        same exception.
+
+        The lookup runs in a task of its own, so it completes for the other
+        callers waiting on it even if the caller that started it is
+        cancelled.
+        """
+        calls: Dict[str, Tuple[asyncio.Future, int]] = {}
+        owned: List[str] = []
+        for key in keys:
+            if key in calls:
+                continue
+            call = self._inflight.get(key)
+            if call is None:
+                owned.append(key)
+                call = (None, len(owned) - 1)
+            calls[key] = call
+
+        coalesced = len(calls) - len(owned)
+        if coalesced:
+            metrics.incr(f"{self.name}.coalesced", coalesced)
+
+        if owned:
+            metrics.incr(f"{self.name}.lookups", len(owned))
+            task = asyncio.ensure_future(self._run(owned, lookup))
+            # retrieved: callers (if any are left) re-raise it themselves
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            for i, key in enumerate(owned):
+                calls[key] = self._inflight[key] = (task, i)
+
+        # shield: a cancelled caller must not cancel a lookup others share
+        results = []
+        for key in keys:
+            task, i = calls[key]
+            results.append((await asyncio.shield(task))[i])
+        return results
+
+    async def _run(
+        self, keys: List[str], lookup: Callable[[List[str]], Awaitable[List[Any]]]
+    ) -> List[Any]:
+        try:
+            return await lookup(keys)
+        finally:
+            for key in keys:
+                self._inflight.pop(key, None)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Background L1 warming jobs for /cache/warm.
+
+A job streams the L2 (MySQL) rows under a path prefix with a server-side
+cursor and writes them into L1 in pipelined chunks, so the scanner's probes
+for that tree hit Redis. Jobs live in the gateway process that started
+them.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from . import metrics
+from .bus import bus
+from .cache_keys import build_cache_key
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class WarmJob:
+    def __init__(self, prefix: str, dev: Optional[int] = None):
+        self.id = uuid.uuid4().hex
+        self.prefix = prefix
+        self.dev = dev
+        self.status = "running"  # running, done, failed or cancelled
+        self.rows = 0
+        self.written = 0
+        self.truncated = False
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def info(self) -> Dict[str, Any]:
+        end = self.finished_at or time.time()
+        return {
+            "job": self.id,
+            "prefix": self.prefix,
+            "dev": self.dev,
+            "status": self.status,
+            "rows": self.rows,
+            "written": self.written,
+            "truncated": self.truncated,
+            "error": self.error,
+            "elapsed": round(end - self.started_at, 3),
+        }
+
+
+class CacheWarmer:
+    """
+    Runs WarmJobs, at most SNAPFS_CACHE_WARM_MAX_JOBS at a time. Finished
+    jobs stay queryable for SNAPFS_CACHE_WARM_KEEP seconds.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, WarmJob] = {}
+
+    def get(self, job_id: str) -> Optional[WarmJob]:
+        self._prune()
+        return self._jobs.get(job_id)
+
+    def start(self, prefix: str, dev: Optional[int] = None) -> Optional[WarmJob]:
+        """
+        Start warming `prefix`, or return the running job already warming
+        it. Returns None if the concurrent job limit is reached.
+        """
+        self._prune()
+        running = [job for job in self._jobs.values() if job.status == "running"]
+        for job in running:
+            if job.prefix == prefix and job.dev == dev:
+                return job
+        if len(running) >= settings.cache_warm_max_jobs:
+            metrics.incr("warm.rejected")
+            return None
+
+        job = WarmJob(prefix, dev)
+        job.task = asyncio.create_task(self._run(job))
+        self._jobs[job.id] = job
+        return job
+
+    async def stop(self):
+        """Cancel running jobs (gateway shutdown)."""
+        tasks = [
+            job.task for job in self._jobs.values() if job.task and not job.task.done()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job: WarmJob):
+        # lazy import to avoid circulars
+        from .db import iter_cached_files
+
+        max_rows = settings.cache_warm_max_rows
+        # One row past the cap tells whether the prefix was truncated
+        chunks = iter_cached_files(
+            job.prefix,
+            job.dev,
+            settings.cache_chunk_size,
+            max_rows + 1 if max_rows else None,
+        )
+        try:
+            async for rows in chunks:
+                if max_rows and job.rows + len(rows) > max_rows:
+                    rows = rows[: max_rows - job.rows]
+                    job.truncated = True
+                job.rows += len(rows)
+                job.written += await bus.cache_set_many(_l1_entries(rows))
+                if job.truncated:
+                    break
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.warning("Cache warm of %s failed (%s).", job.prefix, e)
+        finally:
+            # Release the MySQL connection now rather than at garbage collection
+            await chunks.aclose()
+            job.finished_at = time.time()
+            metrics.incr(f"warm.{job.status}")
+            metrics.incr("warm.rows", job.rows)
+
+    def _prune(self):
+        cutoff = time.time() - settings.cache_warm_keep
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+
+def _l1_entries(rows):
+    # Same keys /ingest seeds, so the scanner's probes find them
+    for row in rows:
+        if not row["algo"] or not row["hash"]:
+            continue
+        key = build_cache_key(
+            path=row["path"],
+            size=int(row["size"]),
+            mtime=float(row["mtime"]),
+            inode=row["inode"],
+            dev=row["dev"],
+        )
+        yield key, {"algo": row["algo"], "hash": row["hash"]}
+
+
+warmer = CacheWarmer()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Tests for snapfs_gateway.ndjson (the /ingest/stream body reader).
+"""
+
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from snapfs_gateway import ndjson
+
+EVENTS = [{"type": "file.upsert", "data": {"path": f"/a/f{i}"}} for i in range(5)]
+BODY = b"".join(json.dumps(e).encode() + b"\n" for e in EVENTS)
+
+
+async def _chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+def read_lines(data: bytes, encoding: str, chunk_size: int = 65536, **kwargs):
+    async def collect():
+        chunks = _chunks(data, chunk_size)
+        return [line async for _, line in ndjson.iter_lines(chunks, encoding, **kwargs)]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+def test_gzip_multiple_members(chunk_size):
+    lines = read_lines(gzip.compress(BODY) + gzip.compress(BODY), "gzip", chunk_size)
+    assert len(lines) == 2 * len(EVENTS)
+    assert [json.loads(line) for line in lines] == EVENTS + EVENTS
+
+
+def test_gzip_truncated_second_member():
+    body = gzip.compress(BODY) + gzip.compress(BODY)[:-4]
+    with pytest.raises(ndjson.CorruptBody):
+        read_lines(body, "gzip")
+
+
+def test_gzip_bomb_hits_line_limit():
+    body = gzip.compress(b"a" * (64 << 20))
+    with pytest.raises(ndjson.LineTooLong):
+        read_lines(body, "gzip", max_line=1 << 20)
+
+
+needs_zstd = pytest.mark.skipif(
+    ndjson.zstandard is None, reason="zstandard not installed"
+)
+
+
+def _zstd_stream(data: bytes) -> bytes:
+    # streaming compression: the frame header declares no content size
+    compressor = ndjson.zstandard.ZstdCompressor().compressobj()
+    return compressor.compress(data) + compressor.flush()
+
+
+@needs_zstd
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+def test_zstd_multiple_frames(chunk_size):
+    frame = ndjson.zstandard.ZstdCompressor(write_checksum=True).compress(BODY)
+    lines = read_lines(frame + _zstd_stream(BODY), "zstd", chunk_size)
+    assert [json.loads(line) for line in lines] == EVENTS + EVENTS
+
+
+@needs_zstd
+@pytest.mark.parametrize("cut", [1, 4, 10])
+def test_zstd_truncated(cut):
+    frame = ndjson.zstandard.ZstdCompressor().compress(BODY)
+    for body in (frame[:-cut], frame + _zstd_stream(BODY)[:-cut]):
+        with pytest.raises(ndjson.CorruptBody):
+            read_lines(body, "zstd")
+
+
+@needs_zstd
+def test_zstd_bomb_hits_line_limit():
+    body = ndjson.zstandard.ZstdCompressor().compress(b"a" * (64 << 20))
+    with pytest.raises(ndjson.LineTooLong):
+        read_lines(body, "zstd", max_line=1 << 20)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025 SnapFS, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__doc__ = """
+Tests for snapfs_gateway.singleflight.
+"""
+
+import asyncio
+
+from snapfs_gateway.singleflight import SingleFlight
+
+
+def test_cancelled_leader_does_not_fail_coalesced_callers():
+    calls = []
+
+    async def lookup(keys):
+        calls.append(list(keys))
+        await asyncio.sleep(0.05)
+        return [key.upper() for key in keys]
+
+    async def run():
+        flight = SingleFlight("test")
+        leader = asyncio.ensure_future(flight.do_many(["a", "b"], lookup))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do_many(["b", "c", "b"], lookup))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == ["B", "C", "B"]
+        assert leader.cancelled()
+        assert len(flight) == 0
+
+    asyncio.run(run())
+    assert calls == [["a", "b"], ["c"]]
+
+
+def test_lookup_error_reaches_every_caller():
+    async def lookup(keys):
+        await asyncio.sleep(0.01)
+        raise ValueError("lookup failed")
+
+    async def run():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(
+            flight.do_many(["a"], lookup),
+            flight.do_many(["a"], lookup),
+            return_exceptions=True,
+        )
+        assert [type(r) for r in results] == [ValueError, ValueError]
+        assert len(flight) == 0
+
+    asyncio.run(run())